@@ -0,0 +1,217 @@
+"""
+Disclosure-risk and information-loss figures of an anonymized result.
+
+Rows are read chunk by chunk as integer codes of the generalized
+quasi-identifiers (and of the sensitive attribute), reduced to the distinct
+code combinations and their counts, and every figure is then derived from that
+small table. Memory therefore grows with the number of distinct combinations,
+not with the number of rows.
+"""
+import numpy as np
+import pandas as pd
+
+from dataset_store import CHUNK_ROWS
+
+# Lower bounds of the class size (and l) histogram bins; the last bin is open-ended
+HISTOGRAM_BINS = [1, 2, 3, 4, 5, 10, 20, 50, 100, 1000, 10000]
+
+
+def _distinct(codes, counts, cards):
+    """
+    Distinct rows of a 2-D code array with their summed counts, and for every
+    input row the index of its distinct row. Rows are packed into one integer
+    key when the cardinalities allow it.
+    """
+    if np.prod([float(card) for card in cards]) < 2 ** 62:
+        strides = np.array([np.prod(cards[j + 1:], dtype=np.int64) for j in range(len(cards))], dtype=np.int64)
+        _, first, inverse = np.unique(codes @ strides, return_index=True, return_inverse=True)
+        uniques = codes[first]
+    else:
+        uniques, inverse = np.unique(codes, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    return uniques, np.bincount(inverse, weights=counts, minlength=len(uniques)).astype(np.int64), inverse
+
+
+def _combination_counts(chunks, cards):
+    """
+    Distinct code combinations of a sequence of 2-D code chunks and their
+    counts. Chunk tables are merged once they outgrow the merged table, so the
+    work stays linear in the number of rows.
+    """
+    table = np.zeros((0, len(cards)), dtype=np.int64)
+    counts = np.zeros(0, dtype=np.int64)
+    pending = []
+    pending_rows = 0
+    for codes in chunks:
+        uniques, chunk_counts, _ = _distinct(codes, np.ones(len(codes), dtype=np.int64), cards)
+        pending.append((uniques, chunk_counts))
+        pending_rows += len(uniques)
+        if pending_rows > max(len(table), CHUNK_ROWS):
+            table, counts = _merge(table, counts, pending, cards)
+            pending, pending_rows = [], 0
+    return _merge(table, counts, pending, cards)
+
+
+def _merge(table, counts, pending, cards):
+    if not pending:
+        return table, counts
+    codes = np.concatenate([table] + [uniques for uniques, _ in pending])
+    weights = np.concatenate([counts] + [chunk_counts for _, chunk_counts in pending])
+    table, counts, _ = _distinct(codes, weights, cards)
+    return table, counts
+
+
+def _histogram(values, weights):
+    """
+    Number of classes and of rows in each HISTOGRAM_BINS bin of values.
+    """
+    edges = np.array(HISTOGRAM_BINS)
+    bins = np.searchsorted(edges, values, side='right') - 1
+    classes = np.bincount(bins, minlength=len(edges))
+    rows = np.bincount(bins, weights=weights, minlength=len(edges)).astype(np.int64)
+    histogram = []
+    for i, low in enumerate(HISTOGRAM_BINS):
+        if i + 1 == len(HISTOGRAM_BINS):
+            label = f"{low}+"
+        elif HISTOGRAM_BINS[i + 1] == low + 1:
+            label = str(low)
+        else:
+            label = f"{low}-{HISTOGRAM_BINS[i + 1] - 1}"
+        histogram.append({'label': label, 'classes': int(classes[i]), 'rows': int(rows[i])})
+    return histogram
+
+
+def _infer_level(values, hierarchy):
+    """
+    Lowest level of a hierarchy whose labels include every value of an output
+    column (anjana does not report the levels it applied).
+    """
+    uniques = pd.Series(pd.unique(values), dtype=object)
+    for lvl, table in enumerate(hierarchy.levels):
+        if uniques.isin(pd.Series(table, dtype=object)).all():
+            return lvl
+    return hierarchy.max_level
+
+
+def _frame_columns(df, quasi_ident, sens, hierarchies):
+    """
+    Codes, cardinalities, missing-label flags and levels of anjana's in-memory result.
+    """
+    if len(df.columns) == 0:
+        # anjana returns a frame without columns when it fails
+        df = pd.DataFrame({col: pd.Series([], dtype=object) for col in quasi_ident + sens})
+    columns = []
+    for col in quasi_ident + sens:
+        codes, uniques = pd.factorize(df[col], use_na_sentinel=False)
+        columns.append((codes, len(uniques), np.asarray(pd.isna(uniques), dtype=bool)))
+    levels = {
+        qi: _infer_level(df[qi], hierarchies[qi]) if qi in hierarchies and len(df) else 0
+        for qi in quasi_ident
+    }
+    n_rows = len(df)
+
+    def chunks():
+        for start in range(0, n_rows, CHUNK_ROWS):
+            yield np.column_stack([codes[start:start + CHUNK_ROWS] for codes, _, _ in columns]).astype(np.int64)
+
+    return chunks(), [card for _, card, _ in columns], [na for _, _, na in columns], levels
+
+
+def _transformed_columns(anonymized, quasi_ident, sens):
+    """
+    Codes, cardinalities, missing-label flags and levels of a built-in engine
+    result, read from the dataset codes of the rows kept.
+    """
+    dataset = anonymized.dataset
+    hierarchies = anonymized.hierarchies
+    # A failed transformation has no levels and no rows
+    levels = {qi: anonymized.transformation.levels.get(qi, 0) for qi in quasi_ident}
+    tables = []
+    for qi in quasi_ident:
+        hierarchy = hierarchies[qi]
+        lvl = levels[qi]
+        tables.append((hierarchy.codes, hierarchy.value_codes(lvl), hierarchy.label_isna(lvl)))
+    for col in sens:
+        codes = hierarchies[col].codes if col in hierarchies else dataset.codes(col)
+        n_values = len(hierarchies[col].levels[0]) if col in hierarchies else len(dataset.categories(col))
+        tables.append((codes, np.arange(n_values), np.zeros(n_values, dtype=bool)))
+    keep = anonymized.alive[-1]
+
+    def chunks():
+        if anonymized.transformation.failed:
+            return
+        for start in range(0, dataset.n_rows, CHUNK_ROWS):
+            rows = start + np.flatnonzero(keep[start:start + CHUNK_ROWS])
+            yield np.column_stack([value_codes[codes[rows]] for codes, value_codes, _ in tables]).astype(np.int64)
+
+    return chunks(), [len(na) for _, _, na in tables], [na for _, _, na in tables], levels
+
+
+def analyze(dataset, anonymized, config):
+    """
+    Disclosure risk and information loss of an anonymized result (a
+    FrameOutput or TransformedOutput of dataset), as a JSON-ready dict:
+
+    - row counts and the fraction of rows suppressed
+    - equivalence classes: number, smallest / average size, a histogram of
+      their sizes and the resulting re-identification risk (prosecutor model)
+    - with one sensitive attribute, the distinct sensitive values per class (l)
+    - per quasi-identifier, the generalization level against the hierarchy
+      height, and the overall precision (1 - mean level / height)
+
+    Like the privacy models, classes with a missing quasi-identifier are left
+    out of the class figures and only counted.
+    """
+    roles = config['roles']
+    quasi_ident = [col for col, r in roles.items() if r == 'quasi']
+    sens_att_list = [col for col, r in roles.items() if r == 'sensitive']
+    sens = sens_att_list[:1] if len(sens_att_list) == 1 else []
+
+    hierarchies = anonymized.hierarchies
+    if hasattr(anonymized, 'transformation'):
+        chunks, cards, na_flags, levels = _transformed_columns(anonymized, quasi_ident, sens)
+    else:
+        chunks, cards, na_flags, levels = _frame_columns(anonymized.df, quasi_ident, sens, hierarchies)
+
+    table, counts = _combination_counts(chunks, cards)
+    m = len(quasi_ident)
+    class_codes, sizes, member = _distinct(table[:, :m], counts, cards[:m])
+    valid = np.ones(len(sizes), dtype=bool)
+    for j in range(m):
+        valid &= ~na_flags[j][class_codes[:, j]]
+
+    rows_out = int(counts.sum())
+    rows_valid = int(sizes[valid].sum())
+    n_classes = int(valid.sum())
+    result = {
+        'rows': dataset.n_rows,
+        'rows_out': rows_out,
+        'suppressed_fraction': 1 - rows_out / dataset.n_rows if dataset.n_rows else 0.0,
+        'rows_missing_qi': rows_out - rows_valid,
+        'classes': n_classes,
+        'min_class_size': int(sizes[valid].min()) if n_classes else None,
+        'average_class_size': rows_valid / n_classes if n_classes else None,
+        'max_risk': 1 / int(sizes[valid].min()) if n_classes else None,
+        'average_risk': n_classes / rows_valid if n_classes else None,
+        'class_sizes': _histogram(sizes[valid], sizes[valid]),
+        'sensitive': sens[0] if sens else None,
+        'min_l': None,
+        'l_values': None,
+    }
+    if sens:
+        diversity = np.bincount(member, minlength=len(sizes))[valid]
+        result['min_l'] = int(diversity.min()) if n_classes else None
+        result['l_values'] = _histogram(diversity, sizes[valid])
+
+    generalization = []
+    for qi in quasi_ident:
+        height = hierarchies[qi].max_level if qi in hierarchies else 0
+        generalization.append({
+            'column': qi,
+            'level': int(levels[qi]),
+            'height': height,
+            'loss': levels[qi] / height if height else 0.0,
+        })
+    result['generalization'] = generalization
+    result['precision'] = 1 - float(np.mean([g['loss'] for g in generalization])) if generalization else 1.0
+    return result
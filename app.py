@@ -1,19 +1,29 @@
 import os
+import logging
+import secrets
+import functools
 try:
     import pandas as pd
     import numpy as np
-    from flask import Flask, render_template, request, redirect, url_for, send_file, flash
-    import anjana.anonymity as anonymity
-    from anjana.anonymity import utils
+    from flask import Flask, render_template, request, redirect, url_for, send_file, flash, jsonify, session, abort, message_flashed
 except ImportError as e:
     print(f"{e}. Installing missing packages...")
     import os
     os.system("pip install pandas numpy flask anjana")  # Install required libraries
     import pandas as pd
     import numpy as np
-    from flask import Flask, render_template, request, redirect, url_for, send_file, flash
-    import anjana.anonymity as anonymity
-    from anjana.anonymity import utils
+    from flask import Flask, render_template, request, redirect, url_for, send_file, flash, jsonify, session, abort, message_flashed
+from dataset_store import DatasetStore
+from jobs import JobManager, JobQueueFull
+from result_cache import ResultCache
+import analytics
+import fileutils
+import hierarchies
+import metrics
+import output
+import pipeline
+import workspaces
+from werkzeug.utils import secure_filename
 
 # import pandas as pd
 # import numpy as np
@@ -21,13 +31,54 @@ except ImportError as e:
 # import anjana.anonymity as anonymity
 # from anjana.anonymity import utils
 
+# Key signing the session cookies when SECRET_KEY is not set. It is created
+# once and shared by every server process, so a session is valid on all of them.
+SECRET_KEY_FILE = os.path.join('instance', 'secret_key')
+
+# Largest upload accepted, in MB; larger requests are refused with 413
+MAX_UPLOAD_MB = int(os.environ.get('MAX_UPLOAD_MB', 1024))
+
+# Queued or running anonymization jobs allowed per session
+MAX_JOBS_PER_SESSION = int(os.environ.get('MAX_JOBS_PER_SESSION', 2))
+
+# Sources the preview API reads from, and the most rows it returns per page
+PREVIEW_SOURCES = ('original', 'anonymized')
+PREVIEW_MAX_ROWS = 1000
+
+def load_secret_key(path=SECRET_KEY_FILE):
+    """
+    Read the key file, creating it first if needed. The key is written to a
+    temporary file and linked into place, so processes starting together
+    all end up with the key of the first one.
+    """
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fileutils.write_text(path, secrets.token_hex(32), overwrite=False)
+    with open(path) as f:
+        return f.read()
+
 app = Flask(__name__)
+app.secret_key = os.environ.get('SECRET_KEY') or load_secret_key()
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_MB * 1024 * 1024
+
+# One JSON line per request / job with the time, rows and memory of each stage
+logging.basicConfig(level=logging.INFO)
+
+# /metrics reports the stages and jobs of every server process
+metrics.registry.share(metrics.SHARED_FOLDER)
+
+# Every upload is parsed once into a columnar cache shared by all routes
+# (and by all server processes, through the cache folder)
+dataset_store = DatasetStore()
 
-# Folders for storing uploaded and processed files
-UPLOAD_FOLDER = 'uploads'
-PROCESSED_FOLDER = 'processed'
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(PROCESSED_FOLDER, exist_ok=True)
+# Anonymization runs in background jobs with a limit on concurrent jobs
+job_manager = JobManager()
+
+# Results are memoized by upload content and configuration, across sessions
+result_cache = ResultCache()
+
+# Named hierarchies are read and checked once, at startup
+hierarchies.library()
 
 def generate_intervals(values, interval):
     """
@@ -41,6 +92,65 @@ def generate_intervals(values, interval):
         intervals.append(f"{lower_bound}-{upper_bound}")
     return np.array(intervals)
 
+def profiling_requested():
+    """
+    Per-request profiling switch: ?profile=1 or the X-Profile: 1 header.
+    """
+    return request.args.get('profile') == '1' or request.headers.get('X-Profile') == '1'
+
+def traced(name):
+    """
+    Run a view inside a metrics.Trace, logging one line with its stages
+    (profiled on request), the HTTP method and the URL and query parameters.
+    Error responses and flashed messages (which all report errors) mark the
+    trace as failed.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            with metrics.Trace(name, profile=profiling_requested(), method=request.method,
+                               args=request.args.to_dict(), **kwargs):
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code >= 400:
+                    metrics.fail((response.get_json(silent=True) or {}).get('error') or response.status)
+                return response
+        return wrapper
+    return decorator
+
+@message_flashed.connect_via(app)
+def flashed_error(sender, message, category):
+    metrics.fail(message)
+
+def current_workspace(create=False):
+    """
+    Workspace of the current session, or None if it has none. Each session
+    only sees its own uploads, results and jobs. Only uploads create a
+    workspace (create=True), so other requests never leave folders behind.
+    """
+    token = session.get('workspace')
+    if token is None:
+        if not create:
+            return None
+        token = secrets.token_hex(16)
+        session['workspace'] = token
+        workspaces.remove_stale(store=dataset_store)
+    workspace = workspaces.Workspace(token)
+    if create:
+        workspace.create()
+    elif not workspace.exists():
+        return None
+    workspace.touch()
+    return workspace
+
+@app.context_processor
+def preview_settings():
+    return {'preview_rows': output.PREVIEW_ROWS}
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    flash(f"The file is too large: uploads are limited to {MAX_UPLOAD_MB} MB.")
+    return redirect(url_for('upload_file'))
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -59,56 +169,58 @@ def upload_file():
             flash("No selected file")
             return redirect(request.url)
         
-        filepath = os.path.join(UPLOAD_FOLDER, file.filename)
-        file.save(filepath)
-        
-        try:
-            df = pd.read_csv(filepath)
-        except Exception as e:
-            flash("Error reading CSV: " + str(e))
-            return redirect(request.url)
-        
-        preview_html = df.head(100).to_html(classes="table table-striped", index=False)
-        return render_template('upload_preview.html', filename=file.filename, preview=preview_html)
+        workspace = current_workspace(create=True)
+        with metrics.Trace('upload', profile=profiling_requested(), filename=file.filename):
+            # The upload is written to the session's workspace under the hash of its
+            # content, parsed into the cache and profiled in a single streaming pass
+            try:
+                with metrics.stage('csv_read') as record:
+                    file_id, dataset = workspace.save_upload(file.stream, file.filename, dataset_store)
+                    record['rows'] = dataset.n_rows
+            except Exception as e:
+                flash("Error reading CSV: " + str(e))
+                return redirect(request.url)
+        # The preview rows are fetched by the page from preview_rows
+        return render_template('upload_preview.html', filename=file.filename, file_id=file_id)
     
     return render_template('upload.html')
 
 @app.route('/select_columns', methods=['GET', 'POST'])
+@traced('select_columns')
 def select_columns():
     """
     Allows the user to assign roles to columns, pick the anonymization method (k-anonymity or l-diversity),
     choose k, suppression level (supp_level), (and l if l-diversity is selected), and define hierarchy types (none, masking, interval)
     for quasi or sensitive columns.
     """
-    filename = request.args.get('filename')
-    if not filename:
+    file_id = request.args.get('file')
+    if not file_id:
         flash("No file provided")
         return redirect(url_for('upload_file'))
     
-    filepath = os.path.join(UPLOAD_FOLDER, filename)
+    workspace = current_workspace()
+    if workspace is None:
+        abort(404)
+    filepath = workspace.upload_path(file_id)
+    if filepath is None or not os.path.exists(filepath):
+        flash("File not found, please upload it again")
+        return redirect(url_for('upload_file'))
+    filename = workspace.name(filepath)
     try:
-        df = pd.read_csv(filepath)
+        with metrics.stage('csv_read') as record:
+            dataset = dataset_store.get(filepath)
+            record['rows'] = dataset.n_rows
     except Exception as e:
         flash("Error reading CSV: " + str(e))
         return redirect(url_for('upload_file'))
     
-    columns = df.columns.tolist()
+    columns = dataset.columns
     
-    # Determine column types (for our purposes, we use pandas detection)
-    col_types = {}
-    for col in columns:
-        if pd.api.types.is_numeric_dtype(df[col]):
-            col_types[col] = "numeric"
-        else:
-            col_types[col] = "string"
-    
-    # Compute maximum string length for each column using the string representation.
-    # This is done for every column so that masking works even for numeric columns.
-    max_len_map = {}
-    for col in columns:
-        max_len_map[col] = df[col].astype(str).apply(len).max()
-    
-    original_preview = df.head(100).to_html(classes="table table-striped", index=False)
+    # Column types (pandas detection) and maximum string lengths come from the
+    # profile built while ingesting, so the full data is not touched here.
+    # The length is computed for every column so that masking works even for numeric columns.
+    col_types = {col: dataset.profile[col]['dtype'] for col in columns}
+    max_len_map = {col: dataset.profile[col]['max_len'] for col in columns}
     
     if request.method == 'POST':
         # Collect roles for each column
@@ -125,11 +237,14 @@ def select_columns():
                 columns=columns,
                 col_types=col_types,
                 max_len_map=max_len_map,
-                original_preview=original_preview
+                filename=filename,
+                file_id=file_id
             )
         
-        # Get the anonymization method (default to k-anonymity)
+        # Get the anonymization method (default to k-anonymity) and the engine running it:
+        # anjana, the built-in engine (same result as anjana) or the built-in lattice search
         method = request.form.get("method", "k_anonymity")
+        engine_name = request.form.get("engine", "anjana")
         
         # Get k and suppression level values
         try:
@@ -142,7 +257,8 @@ def select_columns():
                 columns=columns,
                 col_types=col_types,
                 max_len_map=max_len_map,
-                original_preview=original_preview
+                filename=filename,
+                file_id=file_id
             )
         
         # If l-diversity is selected, get the l value.
@@ -156,268 +272,241 @@ def select_columns():
                     columns=columns,
                     col_types=col_types,
                     max_len_map=max_len_map,
-                    original_preview=original_preview
+                    filename=filename,
+                    file_id=file_id
                 )
         
-        # Build role-based lists
-        quasi_ident = [col for col, r in roles.items() if r == 'quasi']
-        ident = [col for col, r in roles.items() if r == 'ident']
-        sens_att_list = [col for col, r in roles.items() if r == 'sensitive']
-        
-                # Build dynamic hierarchies based on user input.
-        hierarchies = {}
+        # Hierarchy choices per column (the form fields are numbered by column position)
+        hier_types = {}
+        custom = {}
         for i, col in enumerate(columns):
             if col in roles and roles[col] in ['quasi', 'sensitive']:
-                hier_type_field = f"hier_type_{i}"
-                hier_level_field = f"hier_level_{i}"
-                chosen_type = request.form.get(hier_type_field, "none")
-                chosen_level = request.form.get(hier_level_field, "none")
-                                          
-                if chosen_type == "masking":
-
-                    df[col] = df[col].astype(str)
-                    df[col] = df[col].str.strip()
-                    length = df[col].str.len()
-                    if length.nunique() != 1:                
-                        flash('All values of the attritube needs to be of same size in order to do masking')
-                        return redirect(url_for('select_columns', filename=filename))
-                
-
-                    # convert it to string compulsory
-                    try:
-                        mask_level = len(df[col][0]) #int(chosen_level)
-                    except:
-                        mask_level = 0
-                    hierarchy_dict = {0: df[col].values}
-                    for lvl in range(1, mask_level + 1):
-                        def mask_num(n, lvl=lvl):
-                            # if isinstance(n,str):
-                            #     s = n 
-                            # else: #for decimal
-                            #     s = str(int(n))
-                            s = n
-                            return s[:-lvl] + ("*" * lvl) if len(s) > lvl else "*" * lvl
-                        hierarchy_dict[lvl] = df[col].astype(str).apply(mask_num).values
-                    hierarchies[col] = hierarchy_dict
-                # elif chosen_type == "interval":
-                #     try:
-                #         interval_val = int(chosen_level)
-                #     except:
-                #         interval_val = 10
-                #     if interval_val <= 0:
-                #         interval_val = 10
-                #     hierarchies[col] = {
-                #         0: df[col].values,
-                #         1: generate_intervals(df[col].values, interval_val)
-                #     }
-                elif chosen_type == "custom":
-                    custom_text = request.form.get(f"custom_hier_{i}")
-                    if custom_text:
-                        custom_map = {}
-                        lines = custom_text.splitlines()
-                        for line in lines:
-                            if line.strip():
-                                parts = [p.strip() for p in line.split(',')]
-                                if len(parts) > 1:
-                                    custom_map[parts[0]] = parts
-                        if custom_map:
-                            max_level = max(len(v) for v in custom_map.values()) - 1
-                        else:
-                            max_level = 0
-                        hierarchy_dict = {0: df[col].values}
-                        for lvl in range(1, max_level + 1):
-                            hierarchy_dict[lvl] = df[col].astype(str).apply(
-                                lambda x, lvl=lvl: custom_map[x][lvl] if x in custom_map and len(custom_map[x]) > lvl else " not able to map"
-                            ).values
-                        hierarchies[col] = hierarchy_dict
-                    else:
-                        hierarchies[col] = {0: df[col].values}
-
-                elif chosen_type == 'default':
-                    # only applicable for adult.csv dataset with this possible columns
-                                        
-                    if col == 'age':
-                        hierarchies[col] = {
-                            0: df["age"].values,
-                            1: utils.generate_intervals(df["age"].values, 0, 100, 3),
-                            2: utils.generate_intervals(df["age"].values, 0, 100, 5),
-                            3: utils.generate_intervals(df["age"].values, 0, 100, 10),
-                            4: utils.generate_intervals(df["age"].values, 0, 100, 20),
-                            5: utils.generate_intervals(df["age"].values, 0, 100, 50),
-                        }
-                    
-                    if col == 'sex':
-                        hierarchy_dict = {0: df[col].values}
-                        column_hierarchy = {
-                            'Male': ['Male', 'Human'], 
-                            'Female': ['Female', 'Human']
-                        }
-                        max_hierarchy_level = len(next(iter(column_hierarchy.values())))
-                        for lvl in range(1, max_hierarchy_level):
-                            hierarchy_dict[lvl] = df[col].map(
-                                lambda x, lvl=lvl: column_hierarchy.get(x, [" not able to map"] * max_hierarchy_level)[lvl]
-                            ).values
-                        hierarchies[col] = hierarchy_dict
-                    
-                    if col == 'race':
-                        hierarchy_dict = {0: df[col].values}
-                        column_hierarchy = {
-                            'White': ['White', 'White', 'Race'], 
-                            'Black': ['Black', 'Black', 'Race'], 
-                            'Asian-Pac': ['Asian-Pac', 'Asian/Pac', 'Race'], 
-                            'Amer-India': ['Amer-India', 'Native Am', 'Race'], 
-                            'Other': ['Other', 'Other', 'Race']
-                        }
-                        max_hierarchy_level = len(next(iter(column_hierarchy.values())))
-                        for lvl in range(1, max_hierarchy_level):
-                            hierarchy_dict[lvl] = df[col].map(
-                                lambda x, lvl=lvl: column_hierarchy.get(x, [" not able to map"] * max_hierarchy_level)[lvl]
-                            ).values
-                        hierarchies[col] = hierarchy_dict
-                    
-                    if col == 'relationship':
-                        hierarchy_dict = {0: df[col].values}
-                        column_hierarchy = {
-                            'Not-in-family': ['Not-in-family', 'Not Family', 'Relationship'], 
-                            'Husband': ['Husband', 'Spouse', 'Relationship'], 
-                            'Wife': ['Wife', 'Spouse', 'Relationship'], 
-                            'Own-child': ['Own-child', 'Child', 'Relationship'], 
-                            'Unmarried': ['Unmarried', 'Not Family', 'Relationship'], 
-                            'Other-relative': ['Other-relative', 'Other Rela', 'Relationship']
-                        }
-                        max_hierarchy_level = len(next(iter(column_hierarchy.values())))
-                        for lvl in range(1, max_hierarchy_level):
-                            hierarchy_dict[lvl] = df[col].map(
-                                lambda x, lvl=lvl: column_hierarchy.get(x, [" not able to map"] * max_hierarchy_level)[lvl]
-                            ).values
-                        hierarchies[col] = hierarchy_dict
-                    
-                    if col == 'occupation':
-                        hierarchy_dict = {0: df[col].values}
-                        column_hierarchy = {
-                            'Adm-cleric': ['Adm-cleric', 'Clerical/Admin', 'Office/Admin', 'Office/Management', 'Occupation'], 
-                            'Exec-managerial': ['Exec-managerial', 'Executive/Managerial', 'Management/Sales', 'Office/Management', 'Occupation'], 
-                            'Handlers-cleaners': ['Handlers-cleaners', 'Cleaning/Handling', 'Manual Labor', 'General Labor/Service', 'Occupation'], 
-                            'Prof-specialty': ['Prof-specialty', 'Specialized Professional', 'Professional', 'Professional/Specialized', 'Occupation'], 
-                            'Other-service': ['Other-service', 'General Services', 'Service', 'General Labor/Service', 'Occupation'], 
-                            'Sales': ['Sales', 'Sales/Marketing', 'Management/Sales', 'Office/Management', 'Occupation'], 
-                            'Craft-repair': ['Craft-repair', 'Craft/Repair', 'Skilled Trades', 'Skilled Trades/Technical', 'Occupation'], 
-                            'Transport-moving': ['Transport-moving', 'Moving/Transport', 'Transportation', 'Skilled Trades/Technical', 'Occupation'], 
-                            'Farming-fishing': ['Farming-fishing', 'Agriculture/Fishing', 'Manual Labor', 'General Labor/Service', 'Occupation'], 
-                            'Machine-op-inspct': ['Machine-op-inspct', 'Machine Operation', 'Skilled Trades', 'Skilled Trades/Technical', 'Occupation'], 
-                            'Tech-support': ['Tech-support', 'Technical Support', 'Office/Admin', 'Office/Management', 'Occupation'], 
-                            '?': ['?', 'Unclassified', 'Unknown', 'Other/Unknown', 'Occupation'], 
-                            'Protective-serv': ['Protective-serv', 'Protective Services', 'Protective', 'Professional/Specialized', 'Occupation'], 
-                            'Armed-Forces': ['Armed-Forces', 'Armed Forces', 'Military', 'Other/Unknown', 'Occupation'], 
-                            'Priv-house-serv': ['Priv-house-serv', 'Private Household', 'Service', 'General Labor/Service', 'Occupation']
-                        }
-                        max_hierarchy_level = len(next(iter(column_hierarchy.values())))
-                        for lvl in range(1, max_hierarchy_level):
-                            hierarchy_dict[lvl] = df[col].map(
-                                lambda x, lvl=lvl: column_hierarchy.get(x, [" not able to map"] * max_hierarchy_level)[lvl]
-                            ).values
-                        hierarchies[col] = hierarchy_dict
-                    
-                    if col == 'marital-status':
-                        hierarchy_dict = {0: df[col].values}
-                        column_hierarchy = {
-                            'Never-married': ['Never-married', 'Unmarried', 'marital-status'],
-                            'Married-civ-spouse': ['Married-civ-spouse', 'Married', 'marital-status'],
-                            'Divorced': ['Divorced', 'Unmarried', 'marital-status'],
-                            'Married-spouse-absent': ['Married-spouse-absent', 'Married', 'marital-status'],
-                            'Separated': ['Separated', 'Unmarried', 'marital-status'],
-                            'Married-AF-spouse': ['Married-AF-spouse', 'Married', 'marital-status'], 
-                            'Widowed': ['Widowed', 'Unmarried', 'marital-status']
-                        }
-                        max_hierarchy_level = len(next(iter(column_hierarchy.values())))
-                        for lvl in range(1, max_hierarchy_level):
-                            hierarchy_dict[lvl] = df[col].map(
-                                lambda x, lvl=lvl: column_hierarchy.get(x, [" not able to map"] * max_hierarchy_level)[lvl]
-                            ).values
-                        hierarchies[col] = hierarchy_dict
-                    
-                    if col == 'education':
-                        hierarchy_dict = {0: df[col].values}
-                        column_hierarchy = {
-                            "HS-grad": ["HS-grad", "School", "Study"],
-                            "11th": ["11th", "School", "Study"],
-                            "Masters": ["Masters", "Masters", "Study"],
-                            "9th": ["9th", "School", "Study"],
-                            "Some-college": ["Some-college", "School", "Study"],
-                            "Assoc-acdm": ["Assoc-acdm", "School", "Study"],
-                            "Assoc-voc": ["Assoc-voc", "School", "Study"],
-                            "7th-8th": ["7th-8th", "School", "Study"],
-                            "Doctorate": ["Doctorate", "Doctorate", "Study"],
-                            "Prof-school": ["Prof-school", "School", "Study"],
-                            "5th-6th": ["5th-6th", "School", "Study"],
-                            "10th": ["10th", "School", "Study"],
-                            "1st-4th": ["1st-4th", "School", "Study"],
-                            "Preschool": ["Preschool", "Preschool", "Study"],
-                            "12th": ["12th", "School", "Study"],
-                            "Bachelors": ["Bachelors", "Bachelors", "Study"],
-                        }
-                        max_hierarchy_level = len(next(iter(column_hierarchy.values())))
-                        for lvl in range(1, max_hierarchy_level):
-                            hierarchy_dict[lvl] = df[col].map(
-                                lambda x, lvl=lvl: column_hierarchy.get(x, [" not able to map"] * max_hierarchy_level)[lvl]
-                            ).values
-                        hierarchies[col] = hierarchy_dict
-                
-                else:
-                    hierarchies[col] = {0: df[col].values}
-                
-
+                hier_types[col] = request.form.get(f"hier_type_{i}", "none")
+                custom[col] = request.form.get(f"custom_hier_{i}")
         
-        # Run the chosen anonymization
-        try:
-            if method == "l_diversity":
-                if len(sens_att_list) != 1:
-                    flash("For l-diversity, please select exactly one sensitive attribute.")
-                    return redirect(url_for('select_columns', filename=filename))
-                anonymized_df = anonymity.l_diversity(
-                    data=df,
-                    ident=ident,
-                    quasi_ident=quasi_ident,
-                    sens_att=sens_att_list[0],
-                    k=k_value,
-                    l_div=l_div,
-                    supp_level=supp_level_value,
-                    hierarchies=hierarchies
-                )
-                # flash(anonymized_df)
-            else:
-                print(df.shape)
-                anonymized_df = anonymity.k_anonymity(
-                    data=df,
-                    ident=ident,
-                    quasi_ident=quasi_ident,
-                    k=k_value,
-                    supp_level=supp_level_value,
-                    hierarchies=hierarchies
-                )
-        except Exception as e:
-            flash("Anonymization error: " + str(e))
-            return redirect(url_for('select_columns', filename=filename))
+        config = {
+            'roles': roles,
+            'hier_types': hier_types,
+            'custom': custom,
+            'method': method,
+            'engine': engine_name,
+            'k': k_value,
+            'supp_level': supp_level_value,
+            'l_div': l_div if method == "l_diversity" else None,
+        }
+        error = pipeline.validate_config(dataset, config)
+        if error:
+            flash(error)
+            return redirect(url_for('select_columns', file=file_id))
         
-        processed_filename = f'anonymized_{filename}'
-        processed_filepath = os.path.join(PROCESSED_FOLDER, processed_filename)
-        anonymized_df.to_csv(processed_filepath, index=False)
+        if job_manager.active(workspace.jobs) >= MAX_JOBS_PER_SESSION:
+            flash(f"You already have {MAX_JOBS_PER_SESSION} anonymization jobs in progress, please wait for one to finish.")
+            return redirect(url_for('select_columns', file=file_id))
         
-        preview_html = anonymized_df.head(100).to_html(classes="table table-striped", index=False)
-        return render_template('preview.html', anonymized_table=preview_html, download_filename=processed_filename)
+        # The anonymization itself runs in the background; the browser polls the job page.
+        # Its state is saved in the workspace, so any server process can answer the polls.
+        try:
+            job = job_manager.submit(
+                {'filename': filename, 'file_id': file_id},
+                run_anonymization_job, workspace, file_id, config, profiling_requested(),
+                state_folder=workspace.jobs
+            )
+        except JobQueueFull as e:
+            flash(str(e))
+            return redirect(url_for('select_columns', file=file_id))
+        return redirect(url_for('job_page', job_id=job.id))
     
     return render_template(
         'select_columns.html',
         columns=columns,
         col_types=col_types,
         max_len_map=max_len_map,
-        original_preview=original_preview
+        filename=filename,
+        file_id=file_id
+    )
+
+def run_anonymization_job(job, workspace, file_id, config, profile=False):
+    """
+    Background part of select_columns: anonymize an upload of the workspace and
+    write the result to the workspace, named by its result key.
+    """
+    filepath = workspace.upload_path(file_id)
+    filename = workspace.name(filepath)
+    with metrics.Trace('anonymization_job', profile=profile, job=job.id, filename=filename,
+                       method=config['method'], engine=config['engine']):
+        with metrics.stage('csv_read') as record:
+            dataset = dataset_store.get(filepath)
+            record['rows'] = dataset.n_rows
+        
+        # The same content anonymized with the same settings before (in any session): reuse that result
+        key = pipeline.result_key(dataset, config)
+        processed_filepath = workspace.result_path(key)
+        workspace.set_name(processed_filepath, f'anonymized_{filename}')
+        with metrics.stage('result_cache') as record:
+            cached = result_cache.get(key, processed_filepath)
+            record['hit'] = cached is not None
+        if cached is not None:
+            # Pages after the first are read from the parsed copy the stored result already has
+            dataset_store.link(result_cache.path(key), processed_filepath)
+            return {
+                'file_id': file_id,
+                'result_id': key,
+                'preview': cached.get('preview_page'),
+                'analytics': cached.get('analytics'),
+                'cached': True
+            }
+        
+        anonymized = pipeline.anonymize_dataset(dataset, config, progress=job.update)
+        
+        # The anonymized rows are written chunk by chunk; other formats are converted on download.
+        # The same chunks build the parsed copy later preview pages are read from.
+        job.update(stage="writing")
+        with dataset_store.building(processed_filepath) as parsed:
+            preview = output.write_chunks(parsed(anonymized.chunks()), processed_filepath, "csv")
+        
+        # Disclosure risk and information loss of the result, shown with the preview
+        job.update(stage="analyzing")
+        with metrics.stage('analytics', rows=anonymized.n_rows):
+            report = analytics.analyze(dataset, anonymized, config)
+        
+        # The first page of the preview is kept with the result; later pages come from preview_rows
+        preview_page = output.preview_page(preview.head(output.PREVIEW_ROWS), 0, anonymized.n_rows)
+        result_cache.put(key, processed_filepath, {'preview_page': preview_page, 'analytics': report})
+        dataset_store.link(processed_filepath, result_cache.path(key))
+        return {'file_id': file_id, 'result_id': key, 'preview': preview_page, 'analytics': report, 'cached': False}
+
+@app.route('/jobs/<job_id>')
+def job_page(job_id):
+    workspace = current_workspace()
+    if workspace is None:
+        abort(404)
+    job = job_manager.get(job_id, workspace.jobs)
+    if job is None:
+        flash("Unknown or expired job")
+        return redirect(url_for('upload_file'))
+    return render_template('job.html', job=job.to_dict())
+
+@app.route('/jobs/<job_id>/status')
+def job_status(job_id):
+    workspace = current_workspace()
+    job = job_manager.get(job_id, workspace.jobs) if workspace is not None else None
+    if job is None:
+        return jsonify({'error': "Unknown or expired job"}), 404
+    status = job.to_dict()
+    if job.status == "done":
+        status['result_url'] = url_for('job_result', job_id=job_id)
+        status['download_url'] = url_for('download_file', result_id=job.result['result_id'])
+    return jsonify(status)
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    workspace = current_workspace()
+    if workspace is None:
+        abort(404)
+    job = job_manager.get(job_id, workspace.jobs)
+    if job is None:
+        flash("Unknown or expired job")
+        return redirect(url_for('upload_file'))
+    if job.status == "failed":
+        flash("Anonymization error: " + job.error)
+        return redirect(url_for('select_columns', file=job.description['file_id']))
+    if job.status != "done":
+        return redirect(url_for('job_page', job_id=job_id))
+    return render_template(
+        'preview.html',
+        preview_initial=job.result['preview'],
+        analytics=job.result.get('analytics'),
+        file_id=job.result['file_id'],
+        result_id=job.result['result_id'],
+        formats=output.available_formats()
     )
 
-@app.route('/download/<filename>')
-def download_file(filename):
-    filepath = os.path.join(PROCESSED_FOLDER, filename)
-    return send_file(filepath, as_attachment=True)
+@app.route('/api/preview/<source>/<file_id>')
+@traced('preview')
+def preview_rows(source, file_id):
+    """
+    One page of an uploaded (source=original) or anonymized file of the
+    session as JSON, read from its columnar cache: ?offset=0&limit=100.
+    """
+    if source not in PREVIEW_SOURCES:
+        return jsonify({'error': f"Unknown preview source: {source}"}), 404
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = min(max(1, int(request.args.get('limit', output.PREVIEW_ROWS))), PREVIEW_MAX_ROWS)
+    except ValueError:
+        return jsonify({'error': "offset and limit must be integers"}), 400
+    
+    workspace = current_workspace()
+    if workspace is None:
+        return jsonify({'error': "File not found"}), 404
+    filepath = workspace.upload_path(file_id) if source == 'original' else workspace.result_path(file_id)
+    if filepath is None or not os.path.exists(filepath):
+        return jsonify({'error': "File not found"}), 404
+    try:
+        with metrics.stage('csv_read') as record:
+            dataset = dataset_store.get(filepath)
+            record['rows'] = dataset.n_rows
+    except pd.errors.EmptyDataError:
+        # Failed anonymization: the file holds no columns at all
+        return jsonify(output.preview_page(pd.DataFrame(), offset, 0))
+    except Exception as e:
+        return jsonify({'error': "Error reading CSV: " + str(e)}), 400
+    
+    rows = slice(min(offset, dataset.n_rows), min(offset + limit, dataset.n_rows))
+    with metrics.stage('preview_page', rows=rows.stop - rows.start):
+        page = output.preview_page(dataset.to_frame(rows=rows), offset, dataset.n_rows)
+    return jsonify(page)
+
+@app.route('/download/<result_id>')
+def download_file(result_id):
+    """
+    Send an anonymized file of the session. The format comes from ?format= or else the Accept
+    header (CSV by default); other formats are converted from the CSV on first
+    request. Range requests are supported, so large downloads can be resumed.
+    """
+    formats = output.available_formats()
+    fmt = request.args.get('format')
+    if fmt is None:
+        mimetypes = [output.FORMATS[f][1] for f in formats]
+        best = request.accept_mimetypes.best_match(mimetypes, default=mimetypes[0])
+        fmt = formats[mimetypes.index(best)]
+    if fmt not in formats:
+        flash(f"Unsupported download format: {fmt}")
+        return redirect(url_for('upload_file'))
+    
+    workspace = current_workspace()
+    if workspace is None:
+        abort(404)
+    filepath = workspace.result_path(result_id)
+    if filepath is None or not os.path.exists(filepath):
+        flash("File not found, please run the anonymization again")
+        return redirect(url_for('upload_file'))
+    # The file is sent under the name of the upload it was made from
+    download_name = output.format_path(secure_filename(workspace.name(filepath)) or 'anonymized.csv', fmt)
+    try:
+        filepath = output.convert(filepath, fmt)
+    except Exception as e:
+        flash("Error converting file: " + str(e))
+        return redirect(url_for('upload_file'))
+    
+    response = send_file(
+        filepath,
+        as_attachment=True,
+        mimetype=output.FORMATS[fmt][1],
+        download_name=download_name,
+        conditional=True
+    )
+    response.vary.add('Accept')
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """
+    Stage durations, rows, memory and jobs of all the server processes, in
+    the Prometheus text format.
+    """
+    return metrics.registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
 
 if __name__ == '__main__':
+    # Development server; see wsgi.py for serving with several worker processes
     app.run(debug=True)
@@ -0,0 +1,262 @@
+"""
+Benchmark of the anonymization pipeline on generated adult-like data.
+
+Generates CSV files with the columns of adult.csv (plus extra zip-code
+columns when more quasi-identifiers are requested), then runs the same
+stages as an anonymization job of the web app for every combination of
+method, engine and hierarchy type, and reports the time spent in each stage
+and the peak memory. Every measurement runs in a fresh process.
+
+Example:
+    python benchmark.py --rows 10000 1000000 --qi 4 7 --engines builtin lattice
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from dataset_store import DatasetStore, CHUNK_ROWS
+from hierarchies import ValueHierarchy, library
+import metrics
+import output
+import pipeline
+
+# Folder receiving the generated datasets, their parsed cache and the outputs
+BENCHMARK_FOLDER = 'benchmark_data'
+
+# Quasi-identifier columns in the order they are picked; zip-code columns are added beyond these
+ADULT_QUASI_IDENTIFIERS = ['age', 'education', 'marital-status', 'occupation', 'relationship', 'race', 'sex']
+
+SENSITIVE_COLUMN = 'salary-class'
+
+METHODS = ['k_anonymity', 'l_diversity']
+ENGINES = ['anjana', 'builtin', 'lattice']
+HIERARCHY_TYPES = ['masking', 'custom', 'default']
+
+
+def _quasi_identifiers(n_qi):
+    extra = [f'zip-{i + 1}' for i in range(max(0, n_qi - len(ADULT_QUASI_IDENTIFIERS)))]
+    return (ADULT_QUASI_IDENTIFIERS + extra)[:n_qi]
+
+
+def _generate_chunk(rng, n_rows, n_qi):
+    # Skewed frequencies, like the real data: the first values are the most common
+    data = {'age': np.clip(rng.normal(38, 13, n_rows), 17, 90).astype(int)}
+    for col in ADULT_QUASI_IDENTIFIERS[1:]:
+        values = library().get(col).values.to_numpy(dtype=object)
+        weights = 1 / np.arange(1, len(values) + 1)
+        data[col] = rng.choice(values, size=n_rows, p=weights / weights.sum())
+    for col in _quasi_identifiers(n_qi)[len(ADULT_QUASI_IDENTIFIERS):]:
+        data[col] = rng.integers(10000, 10000 + rng.integers(50, 5000), n_rows)
+    data[SENSITIVE_COLUMN] = rng.choice(np.array(['<=50K', '>50K'], dtype=object), size=n_rows, p=[0.76, 0.24])
+    return pd.DataFrame(data)
+
+
+def generate(filepath, n_rows, n_qi, seed=0):
+    """
+    Write an adult-like CSV file of n_rows rows, chunk by chunk.
+    """
+    rng = np.random.default_rng(seed)
+    with open(filepath, 'w', newline='') as f:
+        for start in range(0, n_rows, CHUNK_ROWS):
+            chunk = _generate_chunk(rng, min(CHUNK_ROWS, n_rows - start), n_qi)
+            chunk.to_csv(f, index=False, header=(start == 0))
+
+
+def _custom_text(col, categories):
+    """
+    Custom hierarchy text for a column, as a user would enter it.
+    """
+    hierarchy = library().get(col)
+    lines = []
+    for value in categories:
+        if isinstance(hierarchy, ValueHierarchy):
+            parts = hierarchy.parts(value) if value in hierarchy.values else [value]
+        elif col == 'age':
+            decade = value // 10 * 10
+            parts = [value, f"{decade}-{decade + 9}", f"{value // 30 * 30}-{value // 30 * 30 + 29}", "*"]
+        else:
+            text = str(value)
+            parts = [text] + [text[:len(text) - i] + "*" * i for i in range(1, len(text) + 1)]
+        lines.append(",".join(str(p) for p in parts))
+    return "\n".join(lines)
+
+
+def make_config(dataset, n_qi, hier_type, method, engine_name, k, l_div, supp_level):
+    """
+    Configuration of a job, as select_columns builds it from the form.
+
+    masking masks the equal-length columns (age, zip codes) and uses the
+    default hierarchy for the others; default uses the built-in hierarchies
+    and masks the zip codes, which have none; custom uses hierarchies typed
+    in as custom text.
+    """
+    quasi_ident = _quasi_identifiers(n_qi)
+    roles = {col: 'quasi' for col in quasi_ident}
+    roles[SENSITIVE_COLUMN] = 'sensitive'
+    hier_types = {}
+    custom = {}
+    for col in quasi_ident:
+        same_len = dataset.profile[col]['same_len']
+        if hier_type == "custom":
+            hier_types[col] = "custom"
+            custom[col] = _custom_text(col, dataset.categories(col))
+        elif hier_type == "masking" and same_len:
+            hier_types[col] = "masking"
+        elif library().get(col) is not None:
+            hier_types[col] = "default"
+        else:
+            hier_types[col] = "masking"
+    hier_types[SENSITIVE_COLUMN] = "none"
+    return {
+        'roles': roles,
+        'hier_types': hier_types,
+        'custom': custom,
+        'method': method,
+        'engine': engine_name,
+        'k': k,
+        'supp_level': supp_level,
+        'l_div': l_div if method == "l_diversity" else None,
+    }
+
+
+def _peak_memory_mb():
+    # Not reported on Windows
+    peak = metrics.process_peak_rss()
+    return None if peak is None else round(peak / (1024 * 1024), 1)
+
+
+def run_parse(csv_path, cache_folder):
+    """
+    Parse a CSV file into the columnar cache.
+    """
+    start = time.perf_counter()
+    dataset = DatasetStore(cache_folder).get(csv_path)
+    return {'parse': time.perf_counter() - start, 'rows': dataset.n_rows}
+
+
+def run_case(csv_path, cache_folder, out_path, n_qi, hier_type, method, engine_name, k, l_div, supp_level):
+    """
+    Run one anonymization job on an already parsed dataset, stage by stage.
+    """
+    start = time.perf_counter()
+    dataset = DatasetStore(cache_folder).get(csv_path)
+    config = make_config(dataset, n_qi, hier_type, method, engine_name, k, l_div, supp_level)
+
+    stages = {}
+    current = ['load', time.perf_counter()]
+
+    def progress(stage=None, **kwargs):
+        if stage is not None:
+            now = time.perf_counter()
+            stages[current[0]] = stages.get(current[0], 0) + now - current[1]
+            current[:] = [stage, now]
+
+    anonymized = pipeline.anonymize_dataset(dataset, config, progress=progress)
+    progress(stage="writing")
+    preview = output.write_output(anonymized, out_path, "csv")
+    progress(stage="done")
+    os.remove(out_path)
+
+    return {
+        'hierarchies': stages.get('hierarchies', 0),
+        'load': stages.get('load', 0) + stages.get('loading', 0),
+        'anonymize': stages.get('anonymizing', 0),
+        'write': stages.get('writing', 0),
+        'wall': time.perf_counter() - start,
+        'output_columns': len(preview.columns),
+    }
+
+
+def _child(queue, fn, args):
+    try:
+        result = fn(*args)
+    except Exception as e:
+        result = {'error': f"{type(e).__name__}: {e}"}
+    result['peak_mb'] = _peak_memory_mb()
+    queue.put(result)
+
+
+def measure(fn, *args):
+    """
+    Run fn(*args) in a fresh process, so peak memory covers that call only.
+    Worker processes of the lattice search are not included.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_child, args=(queue, fn, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def _format_row(values, widths):
+    return "  ".join(str(v).rjust(w) for v, w in zip(values, widths))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000], help="dataset sizes (10k to 50M)")
+    parser.add_argument('--qi', type=int, nargs='+', default=[len(ADULT_QUASI_IDENTIFIERS)],
+                        help="numbers of quasi-identifiers")
+    parser.add_argument('--methods', nargs='+', choices=METHODS, default=METHODS)
+    parser.add_argument('--engines', nargs='+', choices=ENGINES, default=ENGINES)
+    parser.add_argument('--hierarchies', nargs='+', choices=HIERARCHY_TYPES, default=HIERARCHY_TYPES)
+    parser.add_argument('-k', type=int, default=5)
+    parser.add_argument('-l', '--l-div', type=int, default=2)
+    parser.add_argument('--supp-level', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--folder', default=BENCHMARK_FOLDER, help="where the generated data is kept")
+    parser.add_argument('--json', help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.folder, exist_ok=True)
+    columns = ['rows', 'qi', 'method', 'engine', 'hierarchy', 'parse_s', 'hier_s', 'load_s', 'anon_s', 'write_s',
+               'wall_s', 'peak_mb', 'status']
+    widths = [9, 3, 11, 7, 9, 8, 7, 7, 8, 8, 8, 8, 6]
+    print(_format_row(columns, widths))
+
+    results = []
+    for n_rows in args.rows:
+        for n_qi in args.qi:
+            csv_path = os.path.join(args.folder, f"adult_{n_rows}_{n_qi}qi_seed{args.seed}.csv")
+            if not os.path.exists(csv_path):
+                generate(csv_path, n_rows, n_qi, args.seed)
+            # A fresh cache for every run, so the parse is always measured
+            cache_folder = os.path.join(args.folder, 'cache')
+            shutil.rmtree(cache_folder, ignore_errors=True)
+            parsed = measure(run_parse, csv_path, cache_folder)
+            out_path = os.path.join(args.folder, 'anonymized.csv')
+
+            for method in args.methods:
+                for engine_name in args.engines:
+                    for hier_type in args.hierarchies:
+                        case = measure(run_case, csv_path, cache_folder, out_path, n_qi, hier_type, method,
+                                       engine_name, args.k, args.l_div, args.supp_level)
+                        case.update({
+                            'rows': n_rows, 'qi': n_qi, 'method': method, 'engine': engine_name,
+                            'hierarchy': hier_type, 'parse': parsed.get('parse'), 'parse_peak_mb': parsed['peak_mb'],
+                        })
+                        results.append(case)
+                        status = "error" if 'error' in case else "ok"
+                        values = [n_rows, n_qi, method, engine_name, hier_type] + [
+                            f"{case[key]:.3f}" if isinstance(case.get(key), float) else "-"
+                            for key in ['parse', 'hierarchies', 'load', 'anonymize', 'write', 'wall']
+                        ] + [case['peak_mb'], status]
+                        print(_format_row(values, widths), flush=True)
+                        if 'error' in case:
+                            print("    " + case['error'])
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""
+Batch anonymization from the command line, without the web app.
+
+    python cli.py --config config.json "data/*.csv" --output-dir anonymized --format csv.gz --jobs 4
+
+The config file is a JSON file with the roles, hierarchies, method and
+parameters (see job_config.load_config). Every input file is anonymized with
+it and written, chunk by chunk, to the output folder as anonymized_<name>,
+keeping the folder structure of the inputs. Files are processed in parallel
+worker processes.
+"""
+import os
+import sys
+import glob
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Only the standard library is imported up front; pandas, numpy and anjana are
+# loaded by the code that anonymizes, so argument and config errors show up at once
+import job_config
+
+OUTPUT_FORMATS = ['csv', 'csv.gz', 'parquet']
+
+# Dataset store of this process, parsing the input files into the cache folder
+_store = None
+
+
+def anonymize_one(input_path, output_path, config, fmt, cache_folder):
+    """
+    Anonymize one file. Returns the summary of pipeline.anonymize_file, or a
+    dict with the error message if it failed.
+    """
+    global _store
+    import output
+    import pipeline
+    from dataset_store import DatasetStore
+
+    if _store is None:
+        _store = DatasetStore(cache_folder)
+    try:
+        return pipeline.anonymize_file(input_path, output.format_path(output_path, fmt), config, fmt, _store)
+    except Exception as e:
+        return {'input': input_path, 'error': str(e)}
+
+
+def expand_inputs(patterns):
+    """
+    Input files matching the glob patterns, sorted and without duplicates.
+    """
+    paths = set()
+    for pattern in patterns:
+        paths.update(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+    return sorted(paths)
+
+
+def output_paths(inputs, output_dir):
+    """
+    Output path (CSV form) of every input, mirroring the input folders below
+    their common parent.
+    """
+    folders = [os.path.dirname(os.path.abspath(path)) for path in inputs]
+    common = os.path.commonpath(folders)
+    paths = []
+    for path, folder in zip(inputs, folders):
+        name = os.path.basename(path)
+        if not name.endswith('.csv'):
+            name += '.csv'
+        paths.append(os.path.join(output_dir, os.path.relpath(folder, common), f'anonymized_{name}'))
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help="input CSV files or glob patterns (quote them)")
+    parser.add_argument('-c', '--config', required=True, help="JSON config file")
+    parser.add_argument('-o', '--output-dir', default='processed', help="folder receiving the anonymized files")
+    parser.add_argument('-f', '--format', choices=OUTPUT_FORMATS, default='csv', help="output format")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help="files processed in parallel")
+    parser.add_argument('--cache-folder', help="where parsed inputs are kept (a temporary folder by default)")
+    args = parser.parse_args(argv)
+
+    try:
+        config = job_config.load_config(args.config)
+    except (OSError, ValueError) as e:
+        parser.error(f"invalid config: {e}")
+    inputs = expand_inputs(args.inputs)
+    if not inputs:
+        parser.error("no input file matches " + " ".join(args.inputs))
+    outputs = output_paths(inputs, args.output_dir)
+    for path in outputs:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    cache_folder = args.cache_folder or tempfile.mkdtemp(prefix='anonymizer-cache-')
+    jobs = max(1, min(args.jobs, len(inputs)))
+    # Share the cores between the files instead of giving every file a full lattice worker pool
+    os.environ.setdefault('ANONYMIZATION_WORKERS', str(max(1, (os.cpu_count() or 1) // jobs)))
+
+    failed = 0
+    try:
+        if jobs == 1:
+            results = (anonymize_one(i, o, config, args.format, cache_folder) for i, o in zip(inputs, outputs))
+            pool = None
+        else:
+            methods = multiprocessing.get_all_start_methods()
+            ctx = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            pool = ProcessPoolExecutor(max_workers=jobs, mp_context=ctx)
+            futures = [
+                pool.submit(anonymize_one, i, o, config, args.format, cache_folder)
+                for i, o in zip(inputs, outputs)
+            ]
+            results = (future.result() for future in as_completed(futures))
+        for result in results:
+            if 'error' in result:
+                failed += 1
+                print(f"FAILED {result['input']}: {result['error']}", file=sys.stderr, flush=True)
+            else:
+                print(f"done   {result['input']} -> {result['output']} "
+                      f"({result['rows']} rows, {result['seconds']}s)", flush=True)
+        if pool is not None:
+            pool.shutdown()
+    finally:
+        if not args.cache_folder:
+            shutil.rmtree(cache_folder, ignore_errors=True)
+
+    print(f"{len(inputs) - failed} of {len(inputs)} files anonymized")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,492 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+import fileutils
+
+# Folder holding the columnar copy of every parsed upload
+CACHE_FOLDER = 'cache'
+
+# Upper bound on the memory held by datasets kept open by the store
+DATASET_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Upper bound on the disk space used by the parsed copies in the cache folder
+DATASET_DISK_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# Rows parsed per chunk while ingesting a CSV
+CHUNK_ROWS = 100_000
+
+# Number of most frequent values kept in a column profile
+PROFILE_TOP_VALUES = 20
+
+# Bytes read at a time when hashing the rest of a file
+READ_BYTES = 1024 * 1024
+
+
+def _code_dtype(n_categories):
+    """
+    Smallest signed integer type able to hold codes for n_categories values.
+    """
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_categories <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def _kind(values):
+    """
+    Whether values (of one chunk, or the categories so far) are numbers,
+    booleans or strings, the types read_csv gives a column.
+    """
+    kind = values.dtype.kind
+    return "number" if kind in 'iuf' else "bool" if kind == 'b' else "string"
+
+
+def _as_strings(values):
+    """
+    Values in their string form, missing values kept as they are. This is
+    what read_csv gives for a column mixing numbers, booleans and text.
+    """
+    return pd.Index([v if isinstance(v, str) or pd.isna(v) else str(v) for v in values], dtype=object)
+
+
+def _remap_codes(path, mapping):
+    """
+    Replace every code in a .codes.bin file by mapping[code], in place.
+    """
+    codes = np.memmap(path, dtype=np.int32, mode='r+')
+    for start in range(0, len(codes), CHUNK_ROWS):
+        codes[start:start + CHUNK_ROWS] = mapping[codes[start:start + CHUNK_ROWS]]
+    codes.flush()
+    del codes
+
+
+def _profile_column(values, counts):
+    """
+    Summarize a column from its distinct values and their occurrence counts.
+    """
+    lengths = pd.Series(values, dtype=object).astype(str).str.len()
+    top = np.argsort(-counts, kind='stable')[:PROFILE_TOP_VALUES]
+    return {
+        'dtype': "numeric" if pd.api.types.is_numeric_dtype(values.dtype) else "string",
+        'max_len': int(lengths.max()) if len(lengths) else 0,
+        'same_len': bool(lengths.nunique() <= 1),
+        'cardinality': len(values),
+        'value_counts': [[str(values[j]), int(counts[j])] for j in top],
+    }
+
+
+class _TeeReader:
+    """
+    File-like wrapper hashing everything read from src and copying it into dst.
+    """
+
+    def __init__(self, src, dst=None):
+        self.src = src
+        self.dst = dst
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.src.read(size)
+        self.sha256.update(data)
+        if self.dst is not None:
+            self.dst.write(data)
+        return data
+
+
+def _file_sha256(filepath):
+    reader = _TeeReader(open(filepath, 'rb'))
+    with reader.src:
+        while reader.read(READ_BYTES):
+            pass
+    return reader.sha256.hexdigest()
+
+
+class _ColumnWriter:
+    """
+    Codes of the columns of successive frames (the chunks of one CSV file),
+    appended to files of a cache folder while every column is profiled.
+    finish() turns them into the parsed copy DatasetStore loads.
+    """
+
+    def __init__(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.columns = None
+        self.n_rows = 0
+        self.categories = []
+        self.counts = []
+        self.code_files = []
+
+    def add(self, chunk):
+        if self.columns is None:
+            self.columns = chunk.columns.tolist()
+            self.categories = [None] * len(self.columns)
+            self.counts = [np.zeros(0, dtype=np.int64) for _ in self.columns]
+            self.code_files = [open(self._bin_path(i), 'wb') for i in range(len(self.columns))]
+        categories = self.categories
+        counts = self.counts
+        for i, col in enumerate(self.columns):
+            local_codes, uniques = pd.factorize(chunk[col], use_na_sentinel=False)
+            if categories[i] is not None and _kind(uniques) != _kind(categories[i]):
+                # Chunks infer their types separately (e.g. numbers, then a "?"):
+                # keep the column as strings, as one read of the whole file would
+                if _kind(categories[i]) != "string":
+                    self.code_files[i].close()
+                    mapping, merged = pd.factorize(_as_strings(categories[i]), use_na_sentinel=False)
+                    _remap_codes(self._bin_path(i), mapping.astype(np.int32))
+                    self.code_files[i] = open(self._bin_path(i), 'ab')
+                    counts[i] = np.bincount(mapping, weights=counts[i], minlength=len(merged)).astype(np.int64)
+                    categories[i] = pd.Index(merged, dtype=object)
+            string_column = _kind(uniques) == "string" or (
+                categories[i] is not None and _kind(categories[i]) == "string")
+            if string_column and pd.api.types.infer_dtype(uniques, skipna=True) not in ('string', 'empty'):
+                # Values read as numbers in a string column become their text
+                mapping, uniques = pd.factorize(_as_strings(uniques), use_na_sentinel=False)
+                local_codes = mapping[local_codes]
+            if categories[i] is None:
+                categories[i] = pd.Index(uniques)
+                mapping = np.arange(len(uniques))
+            else:
+                mapping = categories[i].get_indexer(uniques)
+                new = mapping == -1
+                if new.any():
+                    mapping[new] = np.arange(len(categories[i]), len(categories[i]) + new.sum())
+                    categories[i] = categories[i].append(pd.Index(uniques[new]))
+            codes = mapping[local_codes].astype(np.int32)
+            self.code_files[i].write(codes.tobytes())
+            chunk_counts = np.bincount(codes, minlength=len(categories[i]))
+            chunk_counts[:len(counts[i])] += counts[i]
+            counts[i] = chunk_counts
+        self.n_rows += len(chunk)
+
+    def _bin_path(self, i):
+        return os.path.join(self.folder, f"{i}.codes.bin")
+
+    def close(self):
+        for f in self.code_files:
+            f.close()
+
+    def finish(self, sha256):
+        """
+        Store every column's codes in the smallest integer type and write the
+        categories, profiles and metadata. Call close() first.
+        """
+        n_rows = self.n_rows
+        profile = {}
+        for i, col in enumerate(self.columns):
+            values = self.categories[i].to_numpy()
+            bin_path = self._bin_path(i)
+            raw = np.memmap(bin_path, dtype=np.int32, mode='r', shape=(n_rows,)) if n_rows else np.zeros(0, np.int32)
+            codes = np.lib.format.open_memmap(
+                os.path.join(self.folder, f"{i}.codes.npy"), mode='w+',
+                dtype=_code_dtype(len(values)), shape=(n_rows,)
+            )
+            for start in range(0, n_rows, CHUNK_ROWS):
+                codes[start:start + CHUNK_ROWS] = raw[start:start + CHUNK_ROWS]
+            codes.flush()
+            del codes, raw
+            os.remove(bin_path)
+            np.save(os.path.join(self.folder, f"{i}.categories.npy"), values, allow_pickle=True)
+            profile[col] = _profile_column(values, self.counts[i])
+        _write_meta(self.folder, self.columns, n_rows, profile, sha256)
+
+
+def _write_meta(folder, columns, n_rows, profile, sha256):
+    meta = {'columns': columns, 'n_rows': n_rows, 'profile': profile, 'sha256': sha256}
+    with open(os.path.join(folder, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+class Dataset:
+    """
+    Columnar, categorical-encoded view of a CSV file.
+
+    Every column is kept as an integer code array (memory-mapped from the cache
+    folder) plus the array of distinct values the codes point into. Decoding a
+    column is a single take() over its categories. content_hash is the SHA-256
+    of the CSV file the dataset was parsed from.
+    """
+
+    def __init__(self, columns, codes, categories, n_rows, profile, content_hash=None):
+        self.columns = list(columns)
+        self._codes = codes
+        self._categories = categories
+        self.n_rows = n_rows
+        self.profile = profile
+        self.content_hash = content_hash
+
+    def codes(self, col):
+        return self._codes[col]
+
+    def categories(self, col):
+        return self._categories[col]
+
+    def column(self, col, rows=None):
+        """
+        Decode a column back to its original values (optionally only some rows).
+        """
+        codes = self._codes[col]
+        if rows is not None:
+            codes = codes[rows]
+        return self._categories[col].take(codes)
+
+    def to_frame(self, columns=None, rows=None):
+        columns = self.columns if columns is None else columns
+        return pd.DataFrame({col: self.column(col, rows) for col in columns}, columns=columns)
+
+    @property
+    def nbytes(self):
+        total = 0
+        for col in self.columns:
+            total += self._codes[col].nbytes
+            total += int(pd.Series(self._categories[col]).memory_usage(deep=True, index=False))
+        return total
+
+
+class DatasetStore:
+    """
+    Parses each CSV once into the cache folder and keeps the most recently used
+    datasets open, evicting the least recently used ones beyond max_bytes. On
+    disk, the least recently used parsed copies are deleted once the cache
+    folder grows beyond max_disk_bytes.
+    """
+
+    def __init__(self, cache_folder=CACHE_FOLDER, max_bytes=DATASET_CACHE_MAX_BYTES,
+                 max_disk_bytes=DATASET_DISK_MAX_BYTES):
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._open = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        os.makedirs(cache_folder, exist_ok=True)
+
+    def _key(self, filepath):
+        # Files with the same name, size and mtime in other folders (e.g. copied
+        # with their mtime) get other keys from their path and inode; a re-upload
+        # to the same path changes size, mtime or inode, giving a new key
+        st = os.stat(filepath)
+        name = os.path.basename(filepath)
+        path_hash = hashlib.sha256(os.path.abspath(filepath).encode()).hexdigest()[:16]
+        return f"{name}-{path_hash}-{st.st_dev}-{st.st_ino}-{st.st_size}-{st.st_mtime_ns}"
+
+    def get(self, filepath):
+        """
+        Return the Dataset for a CSV file, parsing it only if no cached copy exists.
+        """
+        key = self._key(filepath)
+        folder = os.path.join(self.cache_folder, key)
+        with self._lock:
+            if key in self._open:
+                self._open.move_to_end(key)
+                self._touch(folder)
+                return self._open[key]
+
+        if not os.path.exists(os.path.join(folder, 'meta.json')):
+            self._build(filepath, folder)
+        self._touch(folder)
+        dataset = self._load(folder)
+        if dataset.content_hash is None:
+            # Cached before content hashes were recorded
+            dataset.content_hash = _file_sha256(filepath)
+            _write_meta(folder, dataset.columns, dataset.n_rows, dataset.profile, dataset.content_hash)
+
+        with self._lock:
+            self._open[key] = dataset
+            self._sizes[key] = dataset.nbytes
+            self._evict()
+        return dataset
+
+    def _evict(self):
+        total = sum(self._sizes.values())
+        while len(self._open) > 1 and total > self.max_bytes:
+            key, _ = self._open.popitem(last=False)
+            total -= self._sizes.pop(key)
+
+    def _touch(self, folder):
+        # Mark the parsed copy as recently used, so _prune keeps it
+        try:
+            os.utime(folder)
+        except OSError:
+            pass
+
+    def _prune(self, keep):
+        """
+        Delete the least recently used parsed copies (except keep) while the
+        cache folder holds more than max_disk_bytes. Copies of files rebuilt
+        or re-uploaded under a new key are never used again, so they go first.
+        """
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_folder):
+            if not entry.is_dir() or '.tmp-' in entry.name:
+                # Copies still being written
+                continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+            except OSError:
+                # Deleted by another process meanwhile
+                continue
+            total += size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_disk_bytes:
+                break
+            if path != keep:
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+    def discard(self, filepath):
+        """
+        Delete the parsed copy of a CSV file, before the file itself is deleted.
+        """
+        try:
+            key = self._key(filepath)
+        except OSError:
+            return
+        with self._lock:
+            if key in self._open:
+                del self._open[key]
+                del self._sizes[key]
+        shutil.rmtree(os.path.join(self.cache_folder, key), ignore_errors=True)
+
+    def ingest_by_content(self, stream, folder, suffix='.csv'):
+        """
+        Save an uploaded stream in folder while parsing it chunk by chunk into
+        the cache, so the upload is read exactly once. The file is named by the
+        SHA-256 of its content, which is only known once the stream has been
+        read; a file with the same content already there is kept, with its
+        parsed copy. Returns the Dataset and the path of the file.
+        """
+        tmp_path = fileutils.tmp_path(os.path.join(folder, 'upload'))
+        tmp_folder = self._tmp_folder(tmp_path)
+        try:
+            with open(tmp_path, 'wb') as out:
+                reader = _TeeReader(stream, out)
+                self._write_columns(reader, tmp_folder)
+            filepath = os.path.join(folder, reader.sha256.hexdigest() + suffix)
+            if os.path.exists(filepath):
+                os.remove(tmp_path)
+                shutil.rmtree(tmp_folder, ignore_errors=True)
+            else:
+                os.replace(tmp_path, filepath)
+                self._publish(tmp_folder, os.path.join(self.cache_folder, self._key(filepath)))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+            raise
+        return self.get(filepath), filepath
+
+    @contextmanager
+    def building(self, filepath):
+        """
+        Build the parsed copy of a CSV file from the frames it is written from,
+        so that it never has to be read back. Yields a function that passes a
+        sequence of frames on (e.g. to output.write_chunks) while adding them
+        to the copy, which is published once the block has written filepath.
+        """
+        tmp_folder = self._tmp_folder(filepath)
+        writer = _ColumnWriter(tmp_folder)
+
+        def tee(chunks):
+            for chunk in chunks:
+                writer.add(chunk)
+                yield chunk
+
+        try:
+            yield tee
+            writer.close()
+            # A file without columns (failed anonymization) has no parsed copy
+            if writer.columns:
+                writer.finish(_file_sha256(filepath))
+                self._publish(tmp_folder, os.path.join(self.cache_folder, self._key(filepath)))
+        finally:
+            writer.close()
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+
+    def link(self, src, dst):
+        """
+        Give dst, a hard link or copy of the CSV file src, the parsed copy of
+        src (if there is one) rather than parsing it again.
+        """
+        try:
+            src_folder = os.path.join(self.cache_folder, self._key(src))
+            folder = os.path.join(self.cache_folder, self._key(dst))
+        except OSError:
+            return
+        if not os.path.exists(os.path.join(src_folder, 'meta.json')) or os.path.exists(folder):
+            return
+        tmp_folder = self._tmp_folder(dst)
+        try:
+            os.makedirs(tmp_folder)
+            # The files of a published copy are never modified, so they can be shared
+            for name in os.listdir(src_folder):
+                try:
+                    os.link(os.path.join(src_folder, name), os.path.join(tmp_folder, name))
+                except OSError:
+                    shutil.copyfile(os.path.join(src_folder, name), os.path.join(tmp_folder, name))
+            self._publish(tmp_folder, folder)
+        except OSError:
+            # src's copy was pruned meanwhile: dst is parsed when first needed
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+
+    def _tmp_folder(self, filepath):
+        return fileutils.tmp_path(os.path.join(self.cache_folder, os.path.basename(filepath)))
+
+    def _publish(self, tmp_folder, folder):
+        try:
+            os.replace(tmp_folder, folder)
+        except OSError:
+            # Another request finished building the same dataset first
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+        else:
+            self._prune(keep=folder)
+
+    def _build(self, filepath, folder):
+        tmp_folder = self._tmp_folder(filepath)
+        try:
+            with open(filepath, 'rb') as f:
+                self._write_columns(_TeeReader(f), tmp_folder)
+            self._publish(tmp_folder, folder)
+        except Exception:
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+            raise
+
+    def _write_columns(self, reader, folder):
+        """
+        Parse a CSV from a _TeeReader in chunks of CHUNK_ROWS rows, appending each
+        column's codes to disk and profiling every column in the same pass. The
+        content hash is taken from the same read.
+        """
+        writer = _ColumnWriter(folder)
+        try:
+            for chunk in pd.read_csv(reader, chunksize=CHUNK_ROWS):
+                writer.add(chunk)
+        finally:
+            writer.close()
+        # pandas may stop before the end of the stream (e.g. trailing blank lines)
+        while reader.read(READ_BYTES):
+            pass
+        if not writer.columns:
+            raise ValueError("The CSV file has no columns")
+        writer.finish(reader.sha256.hexdigest())
+
+    def _load(self, folder):
+        with open(os.path.join(folder, 'meta.json')) as f:
+            meta = json.load(f)
+        codes = {}
+        categories = {}
+        for i, col in enumerate(meta['columns']):
+            codes[col] = np.load(os.path.join(folder, f"{i}.codes.npy"), mmap_mode='r')
+            categories[col] = np.load(os.path.join(folder, f"{i}.categories.npy"), allow_pickle=True)
+        return Dataset(meta['columns'], codes, categories, meta['n_rows'], meta['profile'], meta.get('sha256'))
@@ -0,0 +1,703 @@
+import os
+import math
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+import metrics
+
+# Generalization nodes whose group tables are kept during a search for deriving
+# their successors, and the most memory those tables may take. Every table is up
+# to the size of the root group table, so they are dropped once the search ends.
+NODE_CACHE_SIZE = 256
+NODE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Upper bound on the equivalence-class statistics kept per evaluated node, so a
+# later search with another k, l or suppression level does not regroup them
+CLASS_STATS_MAX_BYTES = 64 * 1024 * 1024
+
+# Worker processes evaluating lattice nodes in parallel (1 disables the pool)
+ANONYMIZATION_WORKERS = int(os.environ.get('ANONYMIZATION_WORKERS', os.cpu_count() or 1))
+
+# Largest minimal generalization search accepted, as lattice nodes x cells of the
+# root group table (rows x quasi-identifiers): every evaluated node regroups up
+# to that many cells, and on data with few repeated rows a sizeable share of the
+# lattice gets evaluated. Larger searches are refused in favour of the greedy engine.
+LATTICE_MAX_WORK = 10_000_000_000
+
+# Largest lattice accepted whatever the data size (the status of every node is kept)
+LATTICE_MAX_NODES = 1_000_000
+
+# Below this many group-table rows to scan per round (groups x workers), the
+# lattice is searched in-process, one path at a time
+PARALLEL_MIN_WORK = 200_000
+
+
+def _group(columns, counts):
+    """
+    Group rows by the combination of several integer code columns.
+
+    Returns the distinct combinations as a 2-D array (in order of first
+    appearance), the summed counts of each combination and, for every input
+    row, the index of its combination.
+    """
+    n = len(counts)
+    key = np.zeros(n, dtype=np.int64)
+    size = 1
+    for col in columns:
+        card = int(col.max()) + 1 if n else 1
+        if size * card >= 2 ** 62:
+            # Re-densify the partial key before it can overflow
+            key, uniques = pd.factorize(key)
+            key = key.astype(np.int64)
+            size = len(uniques)
+        key = key * card + col
+        size *= card
+    group, uniques = pd.factorize(key)
+    _, first = np.unique(group, return_index=True)
+    codes = np.column_stack([col[first] for col in columns]) if columns else np.zeros((len(first), 0), np.int64)
+    group_counts = np.bincount(group, weights=counts, minlength=len(uniques)).astype(np.int64)
+    return codes.astype(np.int64), group_counts, group
+
+
+class _Node:
+    """
+    A point of the generalization lattice, evaluated as a group table: the
+    distinct label-code combinations present at those levels and their counts.
+
+    root_map sends every group of the ungeneralized data to its group here, or
+    to -1 once it has been suppressed. suppressed tells whether the node (or a
+    predecessor it was derived from) lost records to suppression.
+    """
+
+    def __init__(self, levels, codes, counts, root_map, suppressed=False):
+        self.levels = levels
+        self.codes = codes
+        self.counts = counts
+        self.root_map = root_map
+        self.suppressed = suppressed
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.counts.nbytes + self.root_map.nbytes
+
+
+class _Classes:
+    """
+    Equivalence classes of a node: size and number of distinct sensitive
+    values of each, which table rows belong to it and whether it is valid
+    (pycanon ignores rows with a missing quasi-identifier). member is None for
+    statistics computed in a worker process.
+    """
+
+    def __init__(self, member, sizes, diversity, valid):
+        self.member = member
+        self.sizes = sizes
+        self.diversity = diversity
+        self.valid = valid
+
+    @property
+    def nbytes(self):
+        arrays = [self.member, self.sizes, self.diversity, self.valid]
+        return sum(a.nbytes for a in arrays if a is not None)
+
+
+def _class_stats(codes, counts, levels, na_flags, has_sens):
+    """
+    Equivalence classes of a group table; na_flags[j][lvl] tells which label
+    codes of quasi-identifier j stand for a missing value at level lvl.
+    """
+    m = len(levels)
+    if has_sens:
+        class_codes, sizes, member = _group(list(codes[:, :m].T), counts)
+        diversity = np.bincount(member, minlength=len(sizes))
+    else:
+        class_codes, sizes, member = codes, counts, np.arange(len(counts))
+        diversity = None
+    valid = np.ones(len(sizes), dtype=bool)
+    for j, lvl in enumerate(levels):
+        valid &= ~na_flags[j][lvl][class_codes[:, j]]
+    return _Classes(member, sizes, diversity, valid)
+
+
+def _judge(classes, k, l_div, supp_level, n_rows):
+    """
+    Whether a node satisfies the privacy model once its failing classes are
+    suppressed. Returns (ok, suppressed records, classes to drop).
+    """
+    drop = classes.valid & (classes.sizes < k)
+    if l_div is not None:
+        drop |= classes.valid & (classes.diversity < l_div)
+    records_sup = int(classes.sizes[drop].sum())
+    remaining = (classes.valid & ~drop).any()
+    ok = bool(remaining) and records_sup * 100 / n_rows <= supp_level
+    return ok, records_sup, drop
+
+
+class _SharedArray:
+    """
+    Copy of an array in shared memory, attached by the worker processes
+    instead of being pickled to each of them.
+    """
+
+    def __init__(self, array):
+        self.shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=self.shm.buf)[...] = array
+        self.spec = (self.shm.name, array.shape, array.dtype.str)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def _get_pool(workers):
+    """
+    Process pool shared by all searches, created on first use.
+    """
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # Never fork the (multi-threaded) web server process itself
+            methods = multiprocessing.get_all_start_methods()
+            ctx = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=ctx)
+            _pool_workers = workers
+        return _pool
+
+
+# Shared memory segments attached by this worker process, for the current search
+_attached = {}
+
+
+def _attach_tables(context):
+    name = context['codes'][0]
+    if name not in _attached:
+        while _attached:
+            _, (segments, _) = _attached.popitem()
+            for shm in segments:
+                shm.close()
+        segments = []
+        arrays = []
+        for seg_name, shape, dtype in (context['codes'], context['counts']):
+            # The parent process owns the segment and unlinks it after the search
+            shm = shared_memory.SharedMemory(name=seg_name)
+            segments.append(shm)
+            arrays.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+        _attached[name] = (segments, arrays)
+    return _attached[name][1]
+
+
+def _evaluate_batch(context, batch):
+    """
+    Worker side of the parallel lattice search: compute the class statistics
+    of a batch of nodes from the root group table held in shared memory.
+    """
+    codes, counts = _attach_tables(context)
+    has_sens = context['has_sens']
+    outcomes = []
+    for levels in batch:
+        columns = [context['chains'][j][lvl][codes[:, j]] for j, lvl in enumerate(levels)]
+        if has_sens:
+            columns.append(codes[:, -1])
+        node_codes, node_counts, _ = _group(columns, counts)
+        classes = _class_stats(node_codes, node_counts, levels, context['na_flags'], has_sens)
+        outcomes.append((classes.sizes, classes.diversity, classes.valid))
+    return outcomes
+
+
+class Transformation:
+    """
+    Outcome of the engine: the level applied to each quasi-identifier and the
+    record suppressions, in the order anjana performs them. Each entry of steps
+    is a keep mask over the rows left by the previous step. The anonymized rows
+    are produced from it by output.TransformedOutput.
+    """
+
+    def __init__(self, levels, steps, failed=False):
+        self.levels = levels
+        self.steps = steps
+        self.failed = failed
+
+
+class Engine:
+    """
+    k-anonymity / l-diversity over integer-coded hierarchies.
+
+    The rows are grouped once by their quasi-identifier codes (plus the
+    sensitive code for l-diversity). Every generalization node is then
+    evaluated on a group table derived from an already evaluated predecessor,
+    never on the rows, so the cost depends on the number of distinct
+    combinations instead of the number of records.
+
+    An engine can run several searches (see run); the class statistics of the
+    nodes evaluated by earlier searches are reused.
+    """
+
+    def __init__(self, hierarchies, quasi_ident, sens_codes=None, progress=None):
+        if not quasi_ident:
+            raise ValueError("At least one quasi-identifier is required")
+        self.quasi_ident = list(quasi_ident)
+        self.hierarchies = [hierarchies[qi] for qi in self.quasi_ident]
+        self.max_levels = [h.max_level for h in self.hierarchies]
+        self.has_sens = sens_codes is not None
+        self.nodes_evaluated = 0
+        self.progress = progress
+        self.na_flags = [[h.label_isna(lvl) for lvl in range(h.max_level + 1)] for h in self.hierarchies]
+        self._chains = {}
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._stats = OrderedDict()
+        self._stats_bytes = 0
+
+        columns = [h.value_codes(0)[h.codes].astype(np.int64) for h in self.hierarchies]
+        if self.has_sens:
+            columns.append(np.asarray(sens_codes, dtype=np.int64))
+        self.n_rows = len(columns[0])
+        codes, counts, self.row_group = _group(columns, np.ones(self.n_rows, dtype=np.int64))
+        self.root = _Node(tuple([0] * len(self.quasi_ident)), codes, counts, np.arange(len(counts)))
+
+    # Lattice navigation
+
+    def _chain(self, j, start, stop):
+        """
+        Label codes of quasi-identifier j at level start -> codes at level stop.
+        """
+        key = (j, start, stop)
+        if key not in self._chains:
+            h = self.hierarchies[j]
+            mapping = np.arange(len(h.level_codes(start)[1]))
+            for lvl in range(start + 1, stop + 1):
+                mapping = h.transition(lvl)[mapping]
+            self._chains[key] = mapping
+        return self._chains[key]
+
+    def _derive(self, node, levels):
+        """
+        Group table of a successor node, computed from the table of node.
+        """
+        codes = node.codes.copy()
+        for j, (start, stop) in enumerate(zip(node.levels, levels)):
+            if stop != start:
+                codes[:, j] = self._chain(j, start, stop)[codes[:, j]]
+        new_codes, counts, group = _group(list(codes.T), node.counts)
+        root_map = np.where(node.root_map >= 0, group[node.root_map], -1)
+        return _Node(tuple(levels), new_codes, counts, root_map, node.suppressed)
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the engine: the root group table, the group of every
+        row, the cached class statistics and (during a search) node tables.
+        """
+        return self.root.nbytes + self.row_group.nbytes + self._stats_bytes + self._cache_bytes
+
+    def _remember(self, node):
+        if node.levels in self._cache:
+            self._cache_bytes -= self._cache.pop(node.levels).nbytes
+        self._cache[node.levels] = node
+        self._cache_bytes += node.nbytes
+        while self._cache and (len(self._cache) > NODE_CACHE_SIZE or self._cache_bytes > NODE_CACHE_MAX_BYTES):
+            _, old = self._cache.popitem(last=False)
+            self._cache_bytes -= old.nbytes
+
+    def node(self, levels):
+        """
+        Evaluate a node of the lattice, starting from the cached predecessor
+        with the fewest groups.
+        """
+        levels = tuple(levels)
+        if levels in self._cache:
+            self._cache.move_to_end(levels)
+            return self._cache[levels]
+        parent = min(
+            [self.root] + [n for n in self._cache.values() if all(a <= b for a, b in zip(n.levels, levels))],
+            key=lambda n: len(n.counts)
+        )
+        node = self._derive(parent, levels)
+        self._remember(node)
+        return node
+
+    def _count_nodes(self, n):
+        self.nodes_evaluated += n
+        if self.progress is not None:
+            self.progress(self.nodes_evaluated)
+
+    def _remember_stats(self, levels, classes):
+        if levels in self._stats:
+            self._stats_bytes -= self._stats.pop(levels).nbytes
+        self._stats[levels] = classes
+        self._stats_bytes += classes.nbytes
+        while len(self._stats) > 1 and self._stats_bytes > CLASS_STATS_MAX_BYTES:
+            _, old = self._stats.popitem(last=False)
+            self._stats_bytes -= old.nbytes
+
+    def cached_classes(self, levels):
+        """
+        Class statistics of an unsuppressed node evaluated before, or None.
+        """
+        classes = self._stats.get(levels)
+        if classes is not None:
+            self._stats.move_to_end(levels)
+        return classes
+
+    def classes(self, node):
+        if not node.suppressed:
+            classes = self.cached_classes(node.levels)
+            if classes is not None and classes.member is not None:
+                return classes
+        self._count_nodes(1)
+        classes = _class_stats(node.codes, node.counts, node.levels, self.na_flags, self.has_sens)
+        if not node.suppressed:
+            self._remember_stats(node.levels, classes)
+        return classes
+
+    def _suppress(self, node, classes, drop):
+        """
+        Remove the table rows belonging to the classes flagged in drop.
+        """
+        keep = ~drop[classes.member]
+        new_index = np.where(keep, np.cumsum(keep) - 1, -1)
+        root_map = np.where(node.root_map >= 0, new_index[node.root_map], -1)
+        return _Node(node.levels, node.codes[keep], node.counts[keep], root_map, suppressed=True)
+
+    def _row_keep(self, node):
+        return node.root_map[self.row_group] >= 0
+
+    def _generalize(self, node, candidates):
+        """
+        One step of anjana's greedy walk: generalize the candidate
+        quasi-identifier with the most distinct values, or drop it from the
+        candidates once its hierarchy is exhausted.
+        """
+        distinct = [len(np.unique(node.codes[:, j])) for j in candidates]
+        j = candidates[int(np.argmax(distinct))]
+        if node.levels[j] + 1 > self.max_levels[j]:
+            candidates.remove(j)
+            return node
+        levels = list(node.levels)
+        levels[j] += 1
+        if node.suppressed:
+            # The cached tables hold the suppressed records, so derive from this node
+            return self._derive(node, levels)
+        return self.node(levels)
+
+    def _levels(self, node):
+        return dict(zip(self.quasi_ident, node.levels))
+
+    # Greedy search, identical to anjana
+
+    def _k_stage(self, k, supp_level):
+        if k < 1:
+            raise ValueError(f"Invalid value of k for k-anonymity k={k}")
+        if supp_level > 100 or supp_level < 0:
+            raise ValueError(f"Invalid value of for the suppression level {supp_level}")
+
+        node = self.root
+        candidates = list(range(len(self.quasi_ident)))
+        while True:
+            classes = self.classes(node)
+            sizes = classes.sizes[classes.valid]
+            if len(sizes) == 0:
+                raise ValueError("Every record has a missing quasi-identifier")
+            if sizes.min() >= k:
+                return node, 0, False
+            if k <= sizes.max():
+                drop = classes.valid & (classes.sizes < k)
+                records_sup = int(classes.sizes[drop].sum())
+                if records_sup * 100 / self.n_rows <= supp_level:
+                    return self._suppress(node, classes, drop), records_sup, True
+            if not candidates:
+                metrics.logger.warning(f"The anonymization cannot be carried out for the given value k={k}")
+                return None, 0, False
+            node = self._generalize(node, candidates)
+
+    def k_anonymity(self, k, supp_level):
+        node, _, suppressed = self._k_stage(k, supp_level)
+        if node is None:
+            return Transformation({}, [], failed=True)
+        steps = [self._row_keep(node)] if suppressed else []
+        return Transformation(self._levels(node), steps)
+
+    def l_diversity(self, k, l_div, supp_level):
+        if not self.has_sens:
+            raise ValueError("l-diversity needs the sensitive attribute codes")
+        if l_div < 1:
+            raise ValueError(f"Invalid value of l for l-diversity l={l_div}")
+
+        node, supp_records_k, k_suppressed = self._k_stage(k, supp_level)
+        if node is None:
+            raise ValueError(f"k-anonymity cannot be achieved for k={k}")
+        steps = [self._row_keep(node)] if k_suppressed else []
+
+        def done(node):
+            return Transformation(self._levels(node), steps)
+
+        classes = self.classes(node)
+        if classes.diversity[classes.valid].min() >= l_div:
+            return done(node)
+
+        candidates = list(range(len(self.quasi_ident)))
+        while True:
+            classes = self.classes(node)
+            diversity = classes.diversity[classes.valid]
+            if l_div > diversity.max():
+                # Every class falls short of l, so suppressing them leaves no class at all
+                records_sup = int(classes.sizes[classes.valid].sum())
+                if (records_sup + supp_records_k) * 100 / self.n_rows <= supp_level:
+                    raise ValueError(f"l-diversity cannot be achieved for l={l_div}")
+            if not candidates:
+                metrics.logger.warning(f"l-diversity cannot be achieved for l={l_div}")
+                return Transformation({}, [], failed=True)
+            node = self._generalize(node, candidates)
+            classes = self.classes(node)
+            if classes.diversity[classes.valid].min() >= l_div:
+                return done(node)
+
+    # Lattice search for a minimal generalization
+
+    def _lattice(self):
+        """
+        Every node of the lattice as a row of levels.
+        """
+        dims = [m + 1 for m in self.max_levels]
+        size = math.prod(dims)
+        if size > LATTICE_MAX_NODES or size * self.root.codes.size > LATTICE_MAX_WORK:
+            raise ValueError(
+                f"The generalization lattice ({size} nodes over {len(self.root.counts)} distinct rows) is too large "
+                f"for the minimal generalization search; use fewer quasi-identifiers or the built-in engine"
+            )
+        return np.indices(dims, dtype=np.int16).reshape(len(dims), -1).T
+
+    def _evaluate(self, levels, k, l_div, supp_level):
+        """
+        Evaluate a node against the privacy model, from its cached class
+        statistics when it was evaluated before. Returns (ok, suppressed records).
+        """
+        classes = self.cached_classes(levels)
+        if classes is None:
+            classes = self.classes(self.node(levels))
+        ok, records_sup, _ = _judge(classes, k, l_div, supp_level, self.n_rows)
+        return ok, records_sup
+
+    def _evaluate_parallel(self, batch, workers, shared):
+        """
+        Compute the class statistics of nodes in the worker processes. The root
+        group table is put in shared memory once per search; only the small
+        per-level code maps, the node levels and the statistics are pickled.
+        """
+        if not shared:
+            shared.append(_SharedArray(self.root.codes))
+            shared.append(_SharedArray(self.root.counts))
+        context = {
+            'codes': shared[0].spec,
+            'counts': shared[1].spec,
+            'chains': [[self._chain(j, 0, lvl) for lvl in range(m + 1)] for j, m in enumerate(self.max_levels)],
+            'na_flags': self.na_flags,
+            'has_sens': self.has_sens,
+        }
+        n_batches = min(len(batch), workers * 4)
+        batches = [batch[i::n_batches] for i in range(n_batches)]
+        pool = _get_pool(workers)
+        futures = [pool.submit(_evaluate_batch, context, part) for part in batches]
+        for part, future in zip(batches, futures):
+            for levels, (sizes, diversity, valid) in zip(part, future.result()):
+                self._remember_stats(levels, _Classes(None, sizes, diversity, valid))
+        self._count_nodes(len(batch))
+
+    def lattice_search(self, k, supp_level, l_div=None, workers=1):
+        """
+        Find the lowest generalization satisfying k-anonymity (and l-diversity)
+        within the suppression budget.
+
+        Both properties are monotone along the lattice: generalizing only merges
+        classes, so a successor of a satisfying node satisfies too and a
+        predecessor of a failing node fails too. The search follows Flash:
+        starting from the lowest node whose outcome is not known yet, it builds
+        a path upwards, one generalization step at a time, and binary-searches
+        the path for its lowest satisfying node. Every evaluated node tags all
+        its successors (satisfying) or predecessors (failing), so most nodes
+        are never grouped, and nodes no lower than the best one found are left
+        out. The satisfying nodes of the minimal height are then evaluated;
+        ties go to the node suppressing the fewest records, then to the lowest
+        relative generalization.
+
+        With `workers` processes and enough work, as many paths as workers are
+        searched at once, from the lowest unknown nodes, and their next probes
+        are evaluated together in the worker processes, as are the final
+        candidates. Probes on one path may be settled by another, so a few more
+        nodes get evaluated, but the result is the same.
+        """
+        if k < 1:
+            raise ValueError(f"Invalid value of k for k-anonymity k={k}")
+        if supp_level > 100 or supp_level < 0:
+            raise ValueError(f"Invalid value of for the suppression level {supp_level}")
+        if l_div is not None and l_div < 1:
+            raise ValueError(f"Invalid value of l for l-diversity l={l_div}")
+
+        dims = [m + 1 for m in self.max_levels]
+        nodes = self._lattice()
+        heights = nodes.sum(axis=1)
+        # 1: satisfies, -1: fails, 0: not known yet
+        status = np.zeros(len(nodes), dtype=np.int8)
+        suppressed = {}
+        shared = []
+        best = sum(self.max_levels)
+        # Paths binary-searched at the same time, their probes evaluated together in the workers
+        parallel = workers > 1 and workers * len(self.root.counts) >= PARALLEL_MIN_WORK
+        width = workers if parallel else 1
+
+        def state(levels):
+            return status[np.ravel_multi_index(levels, dims)]
+
+        def judge(levels):
+            nonlocal best
+            ok, records_sup = self._evaluate(levels, k, l_div, supp_level)
+            suppressed[levels] = records_sup
+            if ok:
+                status[(nodes >= levels).all(axis=1)] = 1
+                best = min(best, sum(levels))
+            else:
+                status[(nodes <= levels).all(axis=1)] = -1
+            return ok
+
+        def path_from(levels):
+            # Each step generalizes the quasi-identifier with the lowest relative level
+            path = [levels]
+            while sum(levels) + 1 < best:
+                steps = [
+                    levels[:j] + (levels[j] + 1,) + levels[j + 1:]
+                    for j, m in enumerate(self.max_levels) if levels[j] < m
+                ]
+                steps = [step for step in steps if state(step) == 0]
+                if not steps:
+                    break
+                levels = min(steps, key=lambda step: [lvl / m if m else 1 for lvl, m in zip(step, self.max_levels)])
+                path.append(levels)
+            return {'nodes': path, 'lo': 0, 'hi': len(path) - 1}
+
+        def next_probe(path):
+            # Middle node of the part of the path left to search, once it is not known yet
+            nodes_, lo, hi = path['nodes'], path['lo'], path['hi']
+            while lo <= hi:
+                mid = (lo + hi) // 2
+                known = state(nodes_[mid])
+                if known == 0 and sum(nodes_[mid]) < best:
+                    path['lo'], path['hi'] = lo, hi
+                    return nodes_[mid]
+                if known == -1:
+                    lo = mid + 1
+                else:
+                    # Satisfying, or no lower than the best node found on another path
+                    hi = mid - 1
+            path['lo'], path['hi'] = lo, hi
+            return None
+
+        try:
+            top = tuple(self.max_levels)
+            if not judge(top):
+                return Transformation({}, [], failed=True)
+
+            paths = []
+            while True:
+                probes = {}
+                for path in paths:
+                    levels = next_probe(path)
+                    if levels is not None:
+                        probes[levels] = None
+                paths = [path for path in paths if path['lo'] <= path['hi']]
+                # Start new paths from the lowest nodes not known yet
+                if len(paths) < width:
+                    unknown = np.flatnonzero((status == 0) & (heights < best))
+                    taken = {levels for path in paths for levels in path['nodes']}
+                    for index in unknown[np.argsort(heights[unknown], kind='stable')]:
+                        if len(paths) >= width:
+                            break
+                        start = tuple(int(lvl) for lvl in nodes[index])
+                        if start in taken:
+                            continue
+                        path = path_from(start)
+                        taken.update(path['nodes'])
+                        levels = next_probe(path)
+                        if levels is not None:
+                            paths.append(path)
+                            probes[levels] = None
+                if not probes:
+                    break
+                new = [levels for levels in probes if self.cached_classes(levels) is None]
+                if parallel and len(new) > 1:
+                    self._evaluate_parallel(new, workers, shared)
+                for levels in probes:
+                    if state(levels) == 0:
+                        judge(levels)
+
+            # The satisfying nodes of the minimal height, with their suppressed records
+            candidates = [tuple(int(lvl) for lvl in row) for row in nodes[(heights == best) & (status >= 0)]]
+            batch = [levels for levels in candidates if levels not in suppressed]
+            new = [levels for levels in batch if self.cached_classes(levels) is None]
+            if parallel and len(new) > 1:
+                self._evaluate_parallel(new, workers, shared)
+            for levels in batch:
+                judge(levels)
+            candidates = [levels for levels in candidates if state(levels) == 1]
+        finally:
+            for array in shared:
+                array.close()
+
+        best_node = min(candidates, key=lambda levels: (
+            suppressed[levels],
+            sum(lvl / m for lvl, m in zip(levels, self.max_levels) if m),
+            levels,
+        ))
+        node = self.node(best_node)
+        classes = self.classes(node)
+        _, records_sup, drop = _judge(classes, k, l_div, supp_level, self.n_rows)
+        steps = []
+        if records_sup:
+            steps.append(self._row_keep(self._suppress(node, classes, drop)))
+        return Transformation(self._levels(node), steps)
+
+    def run(self, k, supp_level, l_div=None, search="greedy", workers=1, progress=None):
+        """
+        Run one search and return its Transformation. progress is called with
+        the number of nodes evaluated by this search.
+        """
+        self.progress = progress
+        self.nodes_evaluated = 0
+        try:
+            if search == "lattice":
+                return self.lattice_search(k, supp_level, l_div, workers)
+            if l_div is None:
+                return self.k_anonymity(k, supp_level)
+            return self.l_diversity(k, l_div, supp_level)
+        finally:
+            # Only the class statistics are kept for the next search
+            self._cache.clear()
+            self._cache_bytes = 0
+
+
+def transform(quasi_ident, hierarchies, k, supp_level, sens_codes=None, l_div=None, search="greedy",
+              workers=None, progress=None):
+    """
+    Run the built-in engine and return the Transformation it found.
+
+    hierarchies must hold a Hierarchy for every quasi-identifier. With
+    search="greedy" the result is the same as anjana's k_anonymity (or
+    l_diversity when l_div is given); search="lattice" returns the lowest
+    generalization satisfying the same constraints instead, evaluating the
+    lattice with `workers` processes (ANONYMIZATION_WORKERS by default).
+    progress is called with the number of lattice nodes evaluated so far.
+    """
+    engine = Engine(hierarchies, quasi_ident, sens_codes if l_div is not None else None)
+    return engine.run(k, supp_level, l_div, search, workers or ANONYMIZATION_WORKERS, progress)
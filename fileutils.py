@@ -0,0 +1,93 @@
+"""
+Atomic file writes, for files that other requests, jobs or server processes
+may read while they are being written, and a check of whether the process
+that wrote such a file is still running.
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+
+def tmp_path(path):
+    """
+    Temporary path next to path, unique to this process and thread. A file
+    left there by a crashed run is removed rather than overwritten, as it may
+    be a hard link to a memoized result.
+    """
+    tmp = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    if os.path.isfile(tmp):
+        os.remove(tmp)
+    return tmp
+
+
+@contextmanager
+def replacing(path):
+    """
+    Yield a temporary path to write instead of path. Once the block succeeds
+    the file is moved to path in one step, so readers see the old or the new
+    file but never a partial one; if the block fails it is deleted.
+    """
+    tmp = tmp_path(path)
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def write_text(path, text, overwrite=True):
+    """
+    Write text to path atomically. With overwrite=False an existing file is
+    kept, so of several processes creating the file the first one wins.
+    """
+    tmp = tmp_path(path)
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(text)
+        if overwrite:
+            os.replace(tmp, path)
+        else:
+            try:
+                os.link(tmp, path)
+            except FileExistsError:
+                pass
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def process_start(pid):
+    """
+    Start time of a process (clock ticks since boot), or None if there is no
+    such process or it cannot be read (outside Linux).
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            fields = stat.read()
+    except OSError:
+        return None
+    # starttime is the 22nd field; the command name before it, in parentheses, may hold spaces
+    return int(fields.rsplit(')', 1)[1].split()[19])
+
+
+def process_alive(pid, start=None):
+    """
+    Whether the process pid is running. With the start time recorded by the
+    process (see process_start), a later process that was given the same pid,
+    e.g. after a restart of the server or its container, does not count.
+    """
+    if start is not None:
+        current = process_start(pid)
+        if current is not None:
+            return current == start
+    if os.name != 'posix':
+        # Signal 0 would terminate the process on Windows; assume it is alive
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
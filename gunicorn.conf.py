@@ -0,0 +1,20 @@
+"""
+gunicorn hooks, read by gunicorn when it is started from this folder (see
+wsgi.py). Command line options such as --workers still apply.
+"""
+import os
+import shutil
+
+import metrics
+
+
+def on_starting(server):
+    # Statistics saved by the processes of an earlier run are not reported
+    shutil.rmtree(metrics.SHARED_FOLDER, ignore_errors=True)
+
+
+def post_fork(server, worker):
+    # Share the cores between the worker processes instead of giving every
+    # worker a full lattice worker pool; the app is loaded after this hook
+    # unless gunicorn runs with --preload
+    os.environ.setdefault('ANONYMIZATION_WORKERS', str(max(1, (os.cpu_count() or 1) // server.cfg.workers)))
@@ -0,0 +1,374 @@
+import os
+import json
+import glob
+import hashlib
+import threading
+import functools
+
+import numpy as np
+import pandas as pd
+
+# Label given to values missing from a custom or default hierarchy
+NOT_MAPPED = " not able to map"
+
+# Folder of the hierarchy library: one JSON file per named hierarchy
+HIERARCHY_LIBRARY_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hierarchy_library')
+
+# Compiled custom hierarchies kept, by textarea content
+CUSTOM_HIERARCHY_CACHE_SIZE = 64
+
+
+def check_masking(categories):
+    """
+    Raise ValueError unless all values have the same length once stripped,
+    which masking needs. Returns that length.
+    """
+    lengths = pd.Series(categories, dtype=object).astype(str).str.strip().str.len()
+    if lengths.nunique() != 1:
+        raise ValueError('All values of the attritube needs to be of same size in order to do masking')
+    return int(lengths.iloc[0])
+
+
+def masking_levels(codes, categories):
+    """
+    Masking hierarchy: level n replaces the last n characters with '*'.
+
+    Values are compared as stripped strings, which may merge some categories, so
+    new codes are returned along with the level tables. Raises ValueError if the
+    values are not all of the same length.
+    """
+    mask_level = check_masking(categories)
+    stripped = pd.Series(categories, dtype=object).astype(str).str.strip()
+    new_codes, base = pd.factorize(stripped)
+    codes = new_codes[codes]
+    base = np.asarray(base, dtype=object)
+    levels = [base]
+    if mask_level:
+        # One fixed-width character per cell, so masking a level is a column slice
+        chars = np.asarray(base, dtype=f"<U{mask_level}").view("<U1").reshape(len(base), mask_level)
+        for lvl in range(1, mask_level + 1):
+            masked = chars.copy()
+            masked[:, mask_level - lvl:] = "*"
+            levels.append(masked.view(f"<U{mask_level}").ravel().astype(object))
+    return codes, levels
+
+
+def parse_custom_hierarchy(custom_text):
+    """
+    Parse the custom hierarchy textarea: one value per line with its
+    comma-separated generalizations.
+    """
+    custom_map = {}
+    for line in custom_text.splitlines():
+        if line.strip():
+            parts = [p.strip() for p in line.split(',')]
+            if len(parts) > 1:
+                custom_map[parts[0]] = parts
+    return custom_map
+
+
+class ValueHierarchy:
+    """
+    Generalization of a list of values. Each level above the raw values is a
+    table of distinct labels plus, for every listed value, the index of its
+    label (-1 when the value has no label at that level). Values outside the
+    list, and values without a label, are labelled NOT_MAPPED.
+    """
+
+    def __init__(self, values, labels, codes):
+        self.values = pd.Index(values, dtype=object)
+        self.labels = [np.asarray(table, dtype=object) for table in labels]
+        self.codes = [np.asarray(table, dtype=np.int32) for table in codes]
+
+    @classmethod
+    def from_parts(cls, value_parts):
+        """
+        Compile a value -> [value, label at level 1, label at level 2, ...] dict.
+        """
+        height = max((len(parts) for parts in value_parts.values()), default=1) - 1
+        labels = []
+        codes = []
+        for lvl in range(1, height + 1):
+            level = [parts[lvl] if len(parts) > lvl else None for parts in value_parts.values()]
+            level_codes, level_labels = pd.factorize(pd.Series(level, dtype=object))
+            labels.append(level_labels)
+            codes.append(level_codes)
+        return cls(list(value_parts), labels, codes)
+
+    @classmethod
+    def from_json(cls, spec):
+        """
+        Load the compact form written by to_json, checking it is consistent.
+        """
+        values = spec['values']
+        if len(set(values)) != len(values):
+            raise ValueError("values are not unique")
+        labels = []
+        codes = []
+        for lvl, level in enumerate(spec['levels'], start=1):
+            if len(level['codes']) != len(values):
+                raise ValueError(f"level {lvl} has {len(level['codes'])} codes for {len(values)} values")
+            if any(not -1 <= code < len(level['labels']) for code in level['codes']):
+                raise ValueError(f"level {lvl} has codes outside its labels")
+            labels.append(level['labels'])
+            codes.append(level['codes'])
+        return cls(values, labels, codes)
+
+    def to_json(self):
+        return {
+            'type': "values",
+            'values': self.values.tolist(),
+            'levels': [
+                {'labels': table.tolist(), 'codes': level_codes.tolist()}
+                for table, level_codes in zip(self.labels, self.codes)
+            ],
+        }
+
+    @property
+    def height(self):
+        return len(self.labels)
+
+    def parts(self, value):
+        """
+        The value followed by its label at every level, like a custom hierarchy line.
+        """
+        position = self.values.get_loc(value)
+        return [value] + [
+            table[level_codes[position]] if level_codes[position] >= 0 else NOT_MAPPED
+            for table, level_codes in zip(self.labels, self.codes)
+        ]
+
+    def levels(self, categories):
+        """
+        Level tables of a column from its distinct values, compared as strings.
+        """
+        positions = self.values.get_indexer(pd.Series(categories, dtype=object).astype(str))
+        levels = [categories]
+        for table, level_codes in zip(self.labels, self.codes):
+            # NOT_MAPPED is appended to the labels, and -1 codes point to it
+            lookup = np.append(level_codes, -1)[positions]
+            levels.append(np.append(table, NOT_MAPPED).take(np.where(lookup >= 0, lookup, len(table))))
+        return levels
+
+
+class IntervalHierarchy:
+    """
+    Numeric hierarchy generated by formula: level n groups the values into
+    intervals of width steps[n - 1] between low and high, labelled as anjana's
+    generate_intervals does ("[20, 25)"). Only one label per interval is built.
+    """
+
+    def __init__(self, low, high, steps):
+        self.low = low
+        self.high = high
+        self.steps = list(steps)
+
+    @classmethod
+    def from_json(cls, spec):
+        steps = spec['steps']
+        if not steps or any(not isinstance(step, int) or step < 1 for step in steps):
+            raise ValueError("steps must be positive integers")
+        if not spec['low'] < spec['high']:
+            raise ValueError("low must be below high")
+        return cls(spec['low'], spec['high'], steps)
+
+    def to_json(self):
+        return {'type': "intervals", 'low': self.low, 'high': self.high, 'steps': self.steps}
+
+    @property
+    def height(self):
+        return len(self.steps)
+
+    def levels(self, categories):
+        if not pd.api.types.is_numeric_dtype(np.asarray(categories).dtype):
+            raise ValueError("An interval hierarchy needs a numeric column")
+        levels = [categories]
+        for step in self.steps:
+            bounds = np.arange(self.low, self.high + 1, step)
+            # Interval i is [bounds[i], bounds[i + 1]); a value equal to a bound
+            # falls in the interval below it, and values below low in the first one
+            index = np.maximum(np.searchsorted(bounds, categories), 1) - 1
+            if (index >= len(bounds) - 1).any():
+                raise ValueError(f"Values above {bounds[-1]} are outside the interval hierarchy")
+            labels = np.array([f"[{a}, {b})" for a, b in zip(bounds[:-1], bounds[1:])], dtype=object)
+            levels.append(labels.take(index))
+        return levels
+
+
+def hierarchy_digest(hierarchy):
+    """
+    Hash of a compiled hierarchy's content, used in result and engine cache keys.
+    """
+    return hashlib.sha256(json.dumps(hierarchy.to_json(), sort_keys=True).encode()).hexdigest()
+
+
+_HIERARCHY_TYPES = {'values': ValueHierarchy, 'intervals': IntervalHierarchy}
+
+
+class HierarchyLibrary:
+    """
+    Named hierarchies, read and checked once from the JSON files of a folder
+    (the file name is the hierarchy name). The default hierarchy of a column is
+    the one named after it.
+    """
+
+    def __init__(self, folder=HIERARCHY_LIBRARY_FOLDER):
+        self.folder = folder
+        self.hierarchies = {}
+        self.digests = {}
+        for path in sorted(glob.glob(os.path.join(folder, '*.json'))):
+            name = os.path.splitext(os.path.basename(path))[0]
+            try:
+                with open(path) as f:
+                    spec = json.load(f)
+                hierarchy = _HIERARCHY_TYPES[spec['type']].from_json(spec)
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError(f"Invalid hierarchy {path}: {e!r}")
+            self.hierarchies[name] = hierarchy
+            self.digests[name] = hierarchy_digest(hierarchy)
+
+    def get(self, name):
+        return self.hierarchies.get(name)
+
+    def save(self, name, hierarchy):
+        """
+        Write a compiled hierarchy to the library folder and make it available.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        with open(os.path.join(self.folder, f"{name}.json"), 'w') as f:
+            json.dump(hierarchy.to_json(), f)
+            f.write("\n")
+        self.hierarchies[name] = hierarchy
+        self.digests[name] = hierarchy_digest(hierarchy)
+
+
+_library = None
+_library_lock = threading.Lock()
+
+
+def library():
+    """
+    The hierarchy library of HIERARCHY_LIBRARY_FOLDER, loaded on first use.
+    """
+    global _library
+    with _library_lock:
+        if _library is None:
+            _library = HierarchyLibrary()
+        return _library
+
+
+@functools.lru_cache(maxsize=CUSTOM_HIERARCHY_CACHE_SIZE)
+def compile_custom_hierarchy(custom_text):
+    """
+    Parse and compile the custom hierarchy textarea once per distinct content.
+    Values are sorted, so the order of the lines does not change the result.
+    """
+    return ValueHierarchy.from_parts(dict(sorted(parse_custom_hierarchy(custom_text).items())))
+
+
+def custom_levels(categories, custom_text):
+    return compile_custom_hierarchy(custom_text).levels(categories)
+
+
+def default_levels(col, categories):
+    """
+    Library hierarchy named after the column, or None if there is none.
+    """
+    hierarchy = library().get(col)
+    return None if hierarchy is None else hierarchy.levels(categories)
+
+
+class Hierarchy:
+    """
+    Integer-coded generalization hierarchy of one column.
+
+    Rows are stored once as codes into the column's distinct values, and each
+    level is a small table holding one label per distinct value. Labels for the
+    rows are only produced on request, e.g. when the output is written.
+    """
+
+    def __init__(self, codes, levels):
+        self.codes = codes
+        self.levels = levels
+        self._level_codes = {}
+        self._value_codes = {}
+
+    @property
+    def max_level(self):
+        return len(self.levels) - 1
+
+    def level_codes(self, lvl):
+        """
+        Map every distinct value to the code of its label at a level.
+        Returns (value -> label code array, label array).
+        """
+        if lvl not in self._level_codes:
+            self._level_codes[lvl] = pd.factorize(pd.Series(self.levels[lvl], dtype=object), use_na_sentinel=False)
+        return self._level_codes[lvl]
+
+    def transition(self, lvl):
+        """
+        Map label codes at level lvl - 1 to label codes at level lvl.
+
+        Like anjana, a label is generalized through the first value carrying it,
+        so the result is well defined even if the tables are not consistent.
+        """
+        prev_codes, _ = self.level_codes(lvl - 1)
+        cur_codes, _ = self.level_codes(lvl)
+        _, first = np.unique(prev_codes, return_index=True)
+        return cur_codes[first]
+
+    def value_codes(self, lvl):
+        """
+        Label code at a level for every distinct value, reached level by level.
+        """
+        if lvl not in self._value_codes:
+            if lvl == 0:
+                self._value_codes[lvl] = self.level_codes(0)[0]
+            else:
+                self._value_codes[lvl] = self.transition(lvl)[self.value_codes(lvl - 1)]
+        return self._value_codes[lvl]
+
+    def label_isna(self, lvl):
+        """
+        Which label codes at a level stand for a missing value.
+        """
+        return np.asarray(pd.isna(self.level_codes(lvl)[1]), dtype=bool)
+
+    def labels(self, lvl, rows=None):
+        codes = self.codes if rows is None else self.codes[rows]
+        if lvl == 0:
+            return np.asarray(self.levels[0]).take(codes)
+        _, labels = self.level_codes(lvl)
+        return np.asarray(labels, dtype=object).take(self.value_codes(lvl)[codes])
+
+    def to_anjana(self):
+        """
+        Hierarchy dict in the form expected by anjana, with one entry per distinct
+        value instead of one per row. anjana maps each level through the first
+        matching position, and the tables keep first-appearance order, so the
+        result is the same as with full-length arrays.
+        """
+        return {lvl: table for lvl, table in enumerate(self.levels)}
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + sum(np.asarray(table).nbytes for table in self.levels)
+
+
+def build_hierarchy(col, codes, categories, chosen_type, custom_text=None):
+    """
+    Build the hierarchy of one column from its category codes.
+
+    Every level is a lookup table with one label per category, so the cost
+    depends on the number of distinct values, not on the number of rows.
+    Returns a Hierarchy, or None when the column gets no hierarchy.
+    """
+    if chosen_type == "masking":
+        return Hierarchy(*masking_levels(codes, categories))
+    if chosen_type == "custom" and custom_text:
+        return Hierarchy(codes, custom_levels(categories, custom_text))
+    if chosen_type == "default":
+        levels = default_levels(col, categories)
+        return None if levels is None else Hierarchy(codes, levels)
+    return Hierarchy(codes, [categories])
@@ -0,0 +1,78 @@
+import json
+
+# Accepted values of the declarative config
+ROLES = ["ident", "quasi", "sensitive", "none"]
+METHODS = ["k_anonymity", "l_diversity"]
+ENGINES = ["anjana", "builtin", "lattice"]
+HIERARCHY_TYPES = ["none", "masking", "default", "custom"]
+
+
+def load_config(spec):
+    """
+    Build a config from its declarative form, a dict or the path of a JSON file:
+
+        {
+            "roles": {"Name": "ident", "age": "quasi", "ZIP": "quasi", "Disease": "sensitive"},
+            "hierarchies": {"age": "default", "ZIP": "masking",
+                            "sex": {"custom": ["Male,Human", "Female,Human"]}},
+            "method": "k_anonymity",
+            "engine": "builtin",
+            "k": 3,
+            "supp_level": 0,
+            "l_div": 2
+        }
+
+    Custom hierarchies are given as lines (or one string) in the format of the
+    custom hierarchy text box. Raises ValueError for an invalid config.
+    """
+    if not isinstance(spec, dict):
+        with open(spec) as f:
+            spec = json.load(f)
+
+    unknown = set(spec) - {'roles', 'hierarchies', 'method', 'engine', 'k', 'supp_level', 'l_div'}
+    if unknown:
+        raise ValueError(f"Unknown config keys: {', '.join(sorted(unknown))}")
+    roles = {col: role for col, role in spec.get('roles', {}).items() if role != "none"}
+    if not roles:
+        raise ValueError("The config needs a role for at least one column")
+    for col, role in roles.items():
+        if role not in ROLES:
+            raise ValueError(f"Invalid role {role!r} for column {col}, expected one of {', '.join(ROLES)}")
+
+    hier_types = {}
+    custom = {}
+    for col, hierarchy in spec.get('hierarchies', {}).items():
+        if roles.get(col) not in ['quasi', 'sensitive']:
+            raise ValueError(f"Column {col} has a hierarchy but is not a quasi-identifier or sensitive")
+        if isinstance(hierarchy, dict) and set(hierarchy) == {'custom'}:
+            lines = hierarchy['custom']
+            hier_types[col] = "custom"
+            custom[col] = lines if isinstance(lines, str) else "\n".join(lines)
+        elif hierarchy in HIERARCHY_TYPES and hierarchy != "custom":
+            hier_types[col] = hierarchy
+        else:
+            raise ValueError(f"Invalid hierarchy for column {col}: {hierarchy!r}")
+
+    method = spec.get('method', "k_anonymity")
+    if method not in METHODS:
+        raise ValueError(f"Invalid method {method!r}, expected one of {', '.join(METHODS)}")
+    engine_name = spec.get('engine', "builtin")
+    if engine_name not in ENGINES:
+        raise ValueError(f"Invalid engine {engine_name!r}, expected one of {', '.join(ENGINES)}")
+    try:
+        k = int(spec.get('k', 3))
+        supp_level = int(spec.get('supp_level', 0))
+        l_div = int(spec.get('l_div', 2)) if method == "l_diversity" else None
+    except (TypeError, ValueError):
+        raise ValueError("k, supp_level and l_div must be integers")
+
+    return {
+        'roles': roles,
+        'hier_types': hier_types,
+        'custom': custom,
+        'method': method,
+        'engine': engine_name,
+        'k': k,
+        'supp_level': supp_level,
+        'l_div': l_div,
+    }
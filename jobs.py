@@ -0,0 +1,222 @@
+import os
+import re
+import json
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import fileutils
+import metrics
+
+# Anonymization jobs running at the same time in one server process; further
+# jobs wait in the queue. Set ANONYMIZATION_JOBS to change it.
+MAX_CONCURRENT_JOBS = int(os.environ.get('ANONYMIZATION_JOBS', 2))
+
+# Jobs allowed to wait for a free slot before new submissions are refused
+MAX_QUEUED_JOBS = 20
+
+# Finished jobs remembered for status and result requests
+JOB_HISTORY = 200
+
+# Seconds between writes of a running job's progress to its state file
+JOB_STATE_INTERVAL = 0.5
+
+JOB_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    """
+    One anonymization request running in the background.
+
+    status goes queued -> running -> done / failed. progress is a dict updated
+    by the running job (stage, lattice nodes evaluated, ...), result holds
+    whatever the job function returned and error the message of a failure.
+
+    With a state_path, the state (and the result, which must then be JSON
+    serializable) is also written to that file, so that every server process
+    can answer status requests for the job.
+    """
+
+    def __init__(self, job_id, description, state_path=None):
+        self.id = job_id
+        self.description = description
+        self.status = "queued"
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.state_path = state_path
+        self.pid = os.getpid()
+        self.pid_start = fileutils.process_start(self.pid)
+        self._saved = 0
+        self._lock = threading.Lock()
+
+    def update(self, **progress):
+        with self._lock:
+            self.progress.update(progress)
+        if self.state_path and time.time() - self._saved >= JOB_STATE_INTERVAL:
+            self.save()
+
+    def save(self):
+        """
+        Write the job state to its state file, atomically.
+        """
+        state = self.to_dict()
+        state['result'] = self.result
+        state['pid'] = self.pid
+        state['pid_start'] = self.pid_start
+        fileutils.write_text(self.state_path, json.dumps(state))
+        self._saved = time.time()
+
+    @classmethod
+    def load(cls, state_path):
+        """
+        Job as last saved by the process running it, or None if there is no
+        such state file. A job whose process has stopped is reported as failed.
+        """
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        job = cls(state['id'], state['description'], state_path)
+        for key in ('status', 'progress', 'result', 'error', 'created', 'started', 'finished', 'pid'):
+            setattr(job, key, state[key])
+        # Saved before start times were recorded: only the pid is checked
+        job.pid_start = state.get('pid_start')
+        if job.status in ("queued", "running") and not fileutils.process_alive(job.pid, job.pid_start):
+            job.status = "failed"
+            job.error = "The server process running this job stopped"
+        return job
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'id': self.id,
+                'description': self.description,
+                'status': self.status,
+                'progress': dict(self.progress),
+                'error': self.error,
+                'created': self.created,
+                'started': self.started,
+                'finished': self.finished,
+            }
+
+
+class JobManager:
+    """
+    Runs jobs on a bounded pool of background threads and keeps their state
+    for polling. Jobs submitted with a state_folder are also saved there, and
+    can be looked up in that folder from any process.
+    """
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT_JOBS, max_queued=MAX_QUEUED_JOBS, history=JOB_HISTORY):
+        self.max_queued = max_queued
+        self.history = history
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix='anonymization')
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, description, fn, *args, state_folder=None, **kwargs):
+        """
+        Queue fn(job, *args, **kwargs) and return the Job tracking it.
+        Raises JobQueueFull if too many jobs are already waiting.
+        """
+        with self._lock:
+            queued = sum(1 for job in self._jobs.values() if job.status == "queued")
+            if queued >= self.max_queued:
+                raise JobQueueFull("Too many anonymization jobs are waiting, please try again later.")
+            job_id = uuid.uuid4().hex
+            state_path = None
+            if state_folder is not None:
+                os.makedirs(state_folder, exist_ok=True)
+                state_path = os.path.join(state_folder, f"{job_id}.json")
+            job = Job(job_id, description, state_path)
+            if state_path:
+                job.save()
+            self._jobs[job.id] = job
+            self._forget_old()
+        self._publish_counts()
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def get(self, job_id, state_folder=None):
+        """
+        A job of this process, or with a state_folder, a job saved there by any process.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if state_folder is None:
+            return job
+        if job is not None and job.state_path == os.path.join(state_folder, f"{job_id}.json"):
+            return job
+        if not JOB_ID.match(job_id):
+            return None
+        return Job.load(os.path.join(state_folder, f"{job_id}.json"))
+
+    def active(self, state_folder):
+        """
+        Number of queued or running jobs saved in a state folder.
+        """
+        if not os.path.isdir(state_folder):
+            return 0
+        count = 0
+        for name in os.listdir(state_folder):
+            if name.endswith('.json'):
+                job = self.get(name[:-len('.json')], state_folder)
+                count += job is not None and job.status in ("queued", "running")
+        return count
+
+    def counts(self):
+        """
+        Number of known jobs in each status.
+        """
+        counts = {status: 0 for status in ("queued", "running", "done", "failed")}
+        with self._lock:
+            for job in self._jobs.values():
+                counts[job.status] += 1
+        return counts
+
+    def _publish_counts(self):
+        metrics.registry.set_gauge(
+            'anonymizer_jobs', 'Anonymization jobs known to the server processes by status.',
+            [({'status': status}, count) for status, count in self.counts().items()]
+        )
+
+    def _forget_old(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in ("done", "failed")]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
+
+    def _run(self, job, fn, args, kwargs):
+        job.status = "running"
+        job.started = time.time()
+        if job.state_path:
+            job.save()
+        self._publish_counts()
+        try:
+            job.result = fn(job, *args, **kwargs)
+            job.status = "done"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished = time.time()
+            if job.state_path:
+                try:
+                    job.save()
+                except (TypeError, ValueError) as e:
+                    # Other processes could not read this result
+                    job.result = None
+                    job.status = "failed"
+                    job.error = f"The job result cannot be saved: {e}"
+                    job.save()
+            self._publish_counts()
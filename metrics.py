@@ -0,0 +1,352 @@
+import io
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import fileutils
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; the process peak memory is then not reported
+    resource = None
+
+logger = logging.getLogger('anonymizer')
+
+# Upper bounds (seconds) of the stage duration histogram buckets
+DURATION_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800]
+
+# Functions listed in the log of a profiled request
+PROFILE_TOP_FUNCTIONS = 25
+
+# Folder where the server processes save their statistics, so that /metrics
+# reports all of them whichever process answers it
+SHARED_FOLDER = os.environ.get('METRICS_FOLDER', os.path.join('instance', 'metrics'))
+
+
+class _Registry:
+    """
+    Stage statistics and gauges of this process, rendered in the Prometheus
+    text format.
+
+    After share(folder), every change is also saved to a file of this process
+    in folder, and render() reports the statistics of all the processes
+    saving there: counters and histograms are added up (including those of
+    processes that have stopped, so they never go down), gauges only over the
+    processes still running.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.folder = None
+        self._reset()
+
+    def _reset(self):
+        self.durations = OrderedDict()
+        self.rows = OrderedDict()
+        self.peak_memory = OrderedDict()
+        self.gauges = OrderedDict()
+        self._pid = os.getpid()
+        self._path = None
+
+    def share(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        with self._lock:
+            self._check_fork()
+            self.folder = folder
+            self._save()
+
+    def observe(self, stage, seconds, rows=None, peak_memory=None):
+        with self._lock:
+            self._check_fork()
+            if stage not in self.durations:
+                self.durations[stage] = {'buckets': [0] * len(DURATION_BUCKETS), 'sum': 0.0, 'count': 0}
+            histogram = self.durations[stage]
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+            if rows is not None:
+                self.rows[stage] = self.rows.get(stage, 0) + rows
+            if peak_memory is not None:
+                self.peak_memory[stage] = peak_memory
+            self._save()
+
+    def set_gauge(self, name, help_text, samples):
+        """
+        Set the samples, (labels dict, value) pairs, of a gauge of this process.
+        """
+        with self._lock:
+            self._check_fork()
+            self.gauges[name] = {'help': help_text, 'samples': [[labels, value] for labels, value in samples]}
+            self._save()
+
+    def _check_fork(self):
+        # A forked server process starts with its own, empty statistics
+        if os.getpid() != self._pid:
+            self._reset()
+
+    def _snapshot(self):
+        return {
+            'pid': self._pid,
+            'pid_start': fileutils.process_start(self._pid),
+            'durations': self.durations,
+            'rows': self.rows,
+            'peak_memory': self.peak_memory,
+            'gauges': self.gauges,
+            'peak_rss': process_peak_rss(),
+        }
+
+    def _save(self):
+        if self.folder is None:
+            return
+        if self._path is None:
+            # The start time keeps a later process reusing the pid from overwriting this file
+            self._path = os.path.join(self.folder, f"{self._pid}-{time.time_ns()}.json")
+        try:
+            fileutils.write_text(self._path, json.dumps(self._snapshot()))
+        except OSError as e:
+            logger.warning(f"Cannot save the metrics of process {self._pid}: {e}")
+
+    def _snapshots(self):
+        """
+        Statistics of this process and of the other processes saving in the
+        shared folder, each with whether the process is running, by pid.
+        """
+        with self._lock:
+            self._check_fork()
+            snapshots = [(json.loads(json.dumps(self._snapshot())), True)]
+            own = self._path
+        if self.folder is None:
+            return snapshots
+        try:
+            names = sorted(os.listdir(self.folder))
+        except OSError:
+            names = []
+        for name in names:
+            path = os.path.join(self.folder, name)
+            if not name.endswith('.json') or path == own:
+                continue
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            snapshots.append((snapshot, fileutils.process_alive(snapshot['pid'], snapshot.get('pid_start'))))
+        return sorted(snapshots, key=lambda item: item[0]['pid'])
+
+    def render(self):
+        """
+        Metrics in the Prometheus text exposition format.
+        """
+        durations = OrderedDict()
+        rows = OrderedDict()
+        peak_memory = OrderedDict()
+        gauges = OrderedDict()
+        peak_rss = []
+        for snapshot, alive in self._snapshots():
+            for stage, histogram in snapshot['durations'].items():
+                total = durations.setdefault(stage, {'buckets': [0] * len(DURATION_BUCKETS), 'sum': 0.0, 'count': 0})
+                total['buckets'] = [a + b for a, b in zip(total['buckets'], histogram['buckets'])]
+                total['sum'] += histogram['sum']
+                total['count'] += histogram['count']
+            for stage, count in snapshot['rows'].items():
+                rows[stage] = rows.get(stage, 0) + count
+            for stage, peak in snapshot['peak_memory'].items():
+                peak_memory[stage] = max(peak_memory.get(stage, 0), peak)
+            if not alive:
+                continue
+            for name, gauge in snapshot['gauges'].items():
+                total = gauges.setdefault(name, {'help': gauge['help'], 'samples': OrderedDict()})
+                for labels, value in gauge['samples']:
+                    key = tuple(sorted(labels.items()))
+                    total['samples'][key] = total['samples'].get(key, 0) + value
+            if snapshot['peak_rss'] is not None:
+                peak_rss.append((snapshot['pid'], snapshot['peak_rss']))
+
+        lines = [
+            '# HELP anonymizer_stage_duration_seconds Time spent in each stage of the anonymization.',
+            '# TYPE anonymizer_stage_duration_seconds histogram',
+        ]
+        for stage, histogram in durations.items():
+            for bound, count in zip(DURATION_BUCKETS, histogram['buckets']):
+                lines.append(f'anonymizer_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+            lines.append(f'anonymizer_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+            lines.append(f'anonymizer_stage_duration_seconds_sum{{stage="{stage}"}} {histogram["sum"]}')
+            lines.append(f'anonymizer_stage_duration_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+        lines += [
+            '# HELP anonymizer_stage_rows_total Rows processed by each stage.',
+            '# TYPE anonymizer_stage_rows_total counter',
+        ]
+        lines += [f'anonymizer_stage_rows_total{{stage="{stage}"}} {count}' for stage, count in rows.items()]
+        lines += [
+            '# HELP anonymizer_stage_peak_memory_bytes Peak traced memory of the last profiled run of each stage (the largest over the processes).',
+            '# TYPE anonymizer_stage_peak_memory_bytes gauge',
+        ]
+        lines += [f'anonymizer_stage_peak_memory_bytes{{stage="{stage}"}} {peak}' for stage, peak in peak_memory.items()]
+        if peak_rss:
+            lines += [
+                '# HELP anonymizer_process_peak_rss_bytes Peak resident memory of each server process.',
+                '# TYPE anonymizer_process_peak_rss_bytes gauge',
+            ]
+            lines += [f'anonymizer_process_peak_rss_bytes{{pid="{pid}"}} {peak}' for pid, peak in peak_rss]
+        for name, gauge in gauges.items():
+            lines += [f'# HELP {name} {gauge["help"]}', f'# TYPE {name} gauge']
+            for key, value in gauge['samples'].items():
+                label_text = ",".join(f'{label}="{val}"' for label, val in key)
+                lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+        return "\n".join(lines) + "\n"
+
+
+registry = _Registry()
+
+
+def process_peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# tracemalloc is process-wide: it runs while at least one profiled trace is open
+_tracing = 0
+_tracing_lock = threading.Lock()
+
+
+def _start_tracing():
+    global _tracing
+    with _tracing_lock:
+        if _tracing == 0:
+            tracemalloc.start()
+        _tracing += 1
+
+
+def _stop_tracing():
+    global _tracing
+    with _tracing_lock:
+        _tracing -= 1
+        if _tracing == 0:
+            tracemalloc.stop()
+
+
+_local = threading.local()
+
+
+class Trace:
+    """
+    Stages of one request or job. Every stage updates the /metrics registry;
+    finish() writes one structured (JSON) log line with all of them.
+
+    With profile=True the peak memory allocated during each stage is traced
+    and the whole trace runs under cProfile, whose busiest functions go to the
+    log. Tracing slows the work down and, being process-wide, also counts
+    allocations of requests running at the same time.
+    """
+
+    def __init__(self, name, profile=False, **fields):
+        self.name = name
+        self.profile = profile
+        self.fields = fields
+        self.stages = []
+        self.start = time.perf_counter()
+        self.error = None
+        self._profiler = None
+        if profile:
+            _start_tracing()
+            self._profiler = cProfile.Profile()
+            try:
+                self._profiler.enable()
+            except ValueError:
+                # Only one profiler can run at a time; memory is still traced
+                self._profiler = None
+
+    def __enter__(self):
+        self._previous = getattr(_local, 'trace', None)
+        _local.trace = self
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _local.trace = self._previous
+        error = str(exc) if exc else self.error
+        self.finish(status="failed" if exc_type or error else "done", error=error)
+        return False
+
+    @contextmanager
+    def stage(self, name, rows=None, **fields):
+        """
+        Time a stage. The yielded dict can be updated with rows (or other
+        fields) known only once the stage has run.
+        """
+        record = {'stage': name, 'rows': rows}
+        record.update(fields)
+        if self.profile:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = round(time.perf_counter() - start, 6)
+            if self.profile:
+                record['peak_memory'] = tracemalloc.get_traced_memory()[1] - base
+            self.stages.append(record)
+            registry.observe(name, record['seconds'], record['rows'], record.get('peak_memory'))
+
+    def finish(self, **fields):
+        entry = {'event': self.name, 'seconds': round(time.perf_counter() - self.start, 6)}
+        entry.update(self.fields)
+        entry.update({key: value for key, value in fields.items() if value is not None})
+        entry['stages'] = self.stages
+        entry['peak_rss'] = process_peak_rss()
+        if self.profile:
+            _stop_tracing()
+        if self._profiler is not None:
+            self._profiler.disable()
+            out = io.StringIO()
+            pstats.Stats(self._profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+            entry['profile'] = out.getvalue()
+            self._profiler = None
+        logger.info(json.dumps(entry, default=str))
+        return entry
+
+
+@contextmanager
+def _untraced_stage(name, rows=None, **fields):
+    record = {'stage': name, 'rows': rows}
+    record.update(fields)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        registry.observe(name, time.perf_counter() - start, record['rows'])
+
+
+def fail(error):
+    """
+    Mark the Trace active in this thread as failed, for errors the request
+    handles itself (e.g. an unreadable CSV file reported to the user).
+    """
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.error = error
+
+
+def stage(name, rows=None, **fields):
+    """
+    Time a stage of the Trace active in this thread, or only update the
+    registry when there is none.
+    """
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return _untraced_stage(name, rows, **fields)
+    return trace.stage(name, rows, **fields)
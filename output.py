@@ -0,0 +1,271 @@
+import os
+import gzip
+import json
+import shutil
+import importlib.util
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import fileutils
+import metrics
+from dataset_store import CHUNK_ROWS
+
+# Parquet output is only offered when pyarrow is installed; it is imported on first use
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+
+# Output formats: name -> (file extension, mime type)
+FORMATS = OrderedDict([
+    ('csv', ('.csv', 'text/csv')),
+    ('csv.gz', ('.csv.gz', 'application/gzip')),
+    ('parquet', ('.parquet', 'application/vnd.apache.parquet')),
+])
+
+# Rows of the anonymized data shown on the result page
+PREVIEW_ROWS = 100
+
+
+def available_formats():
+    return [fmt for fmt in FORMATS if fmt != 'parquet' or HAS_PYARROW]
+
+
+def preview_page(frame, offset, total):
+    """
+    Rows of a preview table page as JSON-ready data: column names, rows as
+    lists (missing values as None), the position of the page and the total rows.
+    """
+    page = json.loads(frame.to_json(orient='split', index=False))
+    return {'columns': page['columns'], 'rows': page['data'], 'offset': offset, 'total': total}
+
+
+def format_path(csv_path, fmt):
+    """
+    Path of the file holding csv_path converted to fmt.
+    """
+    base = csv_path[:-len('.csv')] if csv_path.endswith('.csv') else csv_path
+    return base + FORMATS[fmt][0]
+
+
+class FrameOutput:
+    """
+    Anonymized frame that is already in memory (anjana's result), written in
+    slices. hierarchies are those the frame was anonymized with.
+    """
+
+    def __init__(self, df, hierarchies=None):
+        self.df = df
+        self.hierarchies = hierarchies or {}
+        self.n_rows = len(df)
+
+    def chunks(self, chunk_rows=CHUNK_ROWS):
+        for start in range(0, max(len(self.df), 1), chunk_rows):
+            yield self.df.iloc[start:start + chunk_rows]
+
+
+class TransformedOutput:
+    """
+    Anonymized data described by the generalization levels and suppressions of
+    a Transformation. Rows are produced chunk by chunk from the dataset codes,
+    so the full anonymized frame never exists in memory. The chunks hold exactly
+    the frame anjana returns, including the index columns it adds when it
+    suppresses records.
+    """
+
+    def __init__(self, dataset, transformation, ident, hierarchies, masked=()):
+        self.dataset = dataset
+        self.transformation = transformation
+        self.ident = set(ident)
+        self.hierarchies = hierarchies
+
+        # Columns written as hierarchy labels: masked columns at their base level,
+        # generalized quasi-identifiers at the level chosen by the engine
+        self.labels = {col: (hierarchies[col], 0) for col in masked}
+        for qi, lvl in transformation.levels.items():
+            if lvl > 0:
+                self.labels[qi] = (hierarchies[qi], lvl)
+
+        # Rows present before each suppression step, the last entry being the output rows
+        self.alive = [np.ones(dataset.n_rows, dtype=bool)]
+        for step in transformation.steps:
+            alive = self.alive[-1].copy()
+            alive[alive] = step
+            self.alive.append(alive)
+        self.n_rows = 0 if transformation.failed else int(self.alive[-1].sum())
+
+        # Every suppression resets the index, inserting the old one as the first column
+        self.columns = list(dataset.columns)
+        self.index_columns = []
+        for j in range(len(transformation.steps)):
+            name = 'index' if 'index' not in self.columns else 'level_0'
+            if name in self.columns:
+                raise ValueError(f"cannot insert {name}, already exists")
+            self.columns.insert(0, name)
+            self.index_columns.insert(0, (name, j))
+
+    def _column(self, col, rows):
+        if col in self.ident:
+            return np.full(len(rows), "*", dtype=object)
+        if col in self.labels:
+            hierarchy, lvl = self.labels[col]
+            return hierarchy.labels(lvl, rows)
+        return self.dataset.column(col, rows)
+
+    def chunks(self, chunk_rows=CHUNK_ROWS):
+        if self.transformation.failed:
+            yield pd.DataFrame()
+            return
+        n_rows = self.dataset.n_rows
+        offsets = [0] * len(self.transformation.steps)
+        for start in range(0, max(n_rows, 1), chunk_rows):
+            stop = min(start + chunk_rows, n_rows)
+            rows = np.arange(start, stop)
+            keep = self.alive[-1][start:stop]
+
+            # Position of each row in the frame each suppression step was applied to
+            positions = []
+            for j in range(len(offsets)):
+                alive = self.alive[j][start:stop]
+                positions.append((offsets[j] + np.cumsum(alive) - 1)[keep])
+                offsets[j] += int(alive.sum())
+
+            rows = rows[keep]
+            data = {name: positions[j] for name, j in self.index_columns}
+            for col in self.dataset.columns:
+                data[col] = self._column(col, rows)
+            yield pd.DataFrame(data, columns=self.columns)
+
+
+class _CsvWriter:
+    def __init__(self, filepath, compress=False):
+        if compress:
+            self.f = gzip.open(filepath, 'wt', newline='')
+        else:
+            self.f = open(filepath, 'w', newline='')
+        self.header = True
+
+    def write(self, chunk):
+        chunk.to_csv(self.f, index=False, header=self.header)
+        self.header = False
+
+    def close(self):
+        self.f.close()
+
+
+class _ParquetWriter:
+    def __init__(self, filepath):
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.filepath = filepath
+        self.writer = None
+        self.schema = None
+
+    def _schema(self, chunk):
+        # Text columns are always strings, so a chunk of missing values cannot change the type
+        fields = []
+        for col in chunk.columns:
+            dtype = chunk[col].dtype
+            arrow_type = self.pa.string() if dtype == object else self.pa.from_numpy_dtype(dtype)
+            fields.append(self.pa.field(str(col), arrow_type))
+        return self.pa.schema(fields)
+
+    def write(self, chunk):
+        chunk = chunk.copy()
+        for col in chunk.columns:
+            if chunk[col].dtype == object:
+                chunk[col] = chunk[col].where(chunk[col].isna(), chunk[col].astype(str))
+        if self.writer is None:
+            self.schema = self._schema(chunk)
+            self.writer = self.pq.ParquetWriter(self.filepath, self.schema)
+        self.writer.write_table(self.pa.Table.from_pandas(chunk, schema=self.schema, preserve_index=False))
+
+    def close(self):
+        if self.writer is None:
+            self.pq.write_table(self.pa.table({}), self.filepath)
+        else:
+            self.writer.close()
+
+
+def _open_writer(filepath, fmt):
+    if fmt not in available_formats():
+        raise ValueError(f"Unsupported output format: {fmt}")
+    if fmt == 'parquet':
+        return _ParquetWriter(filepath)
+    return _CsvWriter(filepath, compress=(fmt == 'csv.gz'))
+
+
+def write_chunks(chunks, filepath, fmt='csv', preview_rows=PREVIEW_ROWS):
+    """
+    Write a sequence of frames to filepath in the given format, one chunk at a
+    time. The file is only moved into place once complete. Returns the first
+    preview_rows rows written.
+    """
+    preview = []
+    n_preview = 0
+    with metrics.stage('write', rows=0, format=fmt) as record, fileutils.replacing(filepath) as tmp_path:
+        writer = _open_writer(tmp_path, fmt)
+        try:
+            for chunk in chunks:
+                writer.write(chunk)
+                record['rows'] += len(chunk)
+                if n_preview < preview_rows or not preview:
+                    preview.append(chunk.head(preview_rows - n_preview))
+                    n_preview += len(preview[-1])
+        finally:
+            writer.close()
+    return pd.concat(preview) if len(preview) > 1 else preview[0]
+
+
+def write_output(output, filepath, fmt='csv', chunk_rows=CHUNK_ROWS):
+    """
+    Write a FrameOutput / TransformedOutput and return its preview rows.
+    """
+    return write_chunks(output.chunks(chunk_rows), filepath, fmt)
+
+
+def _csv_dtypes(csv_path):
+    """
+    One type per column valid for every chunk of a CSV file, so the chunks of a
+    conversion share a schema. Mixed numbers become floats, anything else text.
+    """
+    dtypes = {}
+    for chunk in pd.read_csv(csv_path, chunksize=CHUNK_ROWS):
+        for col in chunk.columns:
+            dtype = chunk[col].dtype
+            seen = dtypes.get(col, dtype)
+            if seen != dtype:
+                if seen.kind in 'iuf' and dtype.kind in 'iuf':
+                    dtype = np.result_type(seen, dtype)
+                else:
+                    dtype = np.dtype(object)
+            dtypes[col] = dtype
+    return dtypes
+
+
+def convert(csv_path, fmt):
+    """
+    Convert an anonymized CSV file to another format, streaming it in chunks.
+    Returns the path of the converted file; existing up-to-date conversions are reused.
+    """
+    if fmt == 'csv':
+        return csv_path
+    target = format_path(csv_path, fmt)
+    if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(csv_path):
+        return target
+
+    if fmt == 'csv.gz':
+        with fileutils.replacing(target) as tmp_path:
+            with open(csv_path, 'rb') as src, gzip.open(tmp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        return target
+
+    try:
+        dtypes = _csv_dtypes(csv_path)
+    except pd.errors.EmptyDataError:
+        # Failed anonymization: the CSV holds no columns at all
+        write_chunks([pd.DataFrame()], target, fmt)
+        return target
+    write_chunks(pd.read_csv(csv_path, chunksize=CHUNK_ROWS, dtype=dtypes), target, fmt)
+    return target
@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import analytics
+import engine
+import metrics
+import output
+from dataset_store import DatasetStore
+from hierarchies import Hierarchy, build_hierarchy, check_masking, compile_custom_hierarchy, hierarchy_digest, library
+from output import FrameOutput, TransformedOutput
+
+# Memory of the built-in engines kept between jobs (per process), so that a
+# resubmission changing only k, l or the suppression level reuses the class
+# statistics of the nodes already evaluated (0 disables)
+ENGINE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+_engines = OrderedDict()
+_engines_lock = threading.Lock()
+
+
+def normalize_config(config):
+    """
+    Canonical form of a config: only the settings that change the result, with
+    custom and library hierarchies reduced to a digest of their content.
+    """
+    roles = dict(sorted(config['roles'].items()))
+    hierarchies = {}
+    for col, chosen_type in sorted(config['hier_types'].items()):
+        if roles.get(col) not in ['quasi', 'sensitive'] or chosen_type not in ["masking", "default", "custom"]:
+            continue
+        if chosen_type == "custom":
+            custom = compile_custom_hierarchy(config['custom'].get(col) or "")
+            hierarchies[col] = ["custom", hierarchy_digest(custom)]
+        elif chosen_type == "default":
+            hierarchies[col] = ["default", library().digests.get(col)]
+        else:
+            hierarchies[col] = [chosen_type]
+    return {
+        'roles': roles,
+        'hierarchies': hierarchies,
+        'method': config['method'],
+        'engine': config['engine'],
+        'k': config['k'],
+        'supp_level': config['supp_level'],
+        'l_div': config['l_div'] if config['method'] == "l_diversity" else None,
+    }
+
+
+def result_key(dataset, config):
+    """
+    Key identifying the anonymization of a dataset's content with a config.
+    """
+    description = json.dumps([dataset.content_hash, normalize_config(config)], sort_keys=True)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+def _engine_entry(key):
+    with _engines_lock:
+        if key in _engines:
+            _engines.move_to_end(key)
+            return _engines[key]
+        entry = [None, threading.Lock()]
+        _engines[key] = entry
+        return entry
+
+
+def _trim_engines():
+    """
+    Drop the least recently used engines beyond ENGINE_CACHE_MAX_BYTES.
+    """
+    with _engines_lock:
+        total = sum(entry[0].nbytes for entry in _engines.values() if entry[0] is not None)
+        while _engines and total > ENGINE_CACHE_MAX_BYTES:
+            _, (old, _) = _engines.popitem(last=False)
+            if old is not None:
+                total -= old.nbytes
+
+
+def validate_config(dataset, config):
+    """
+    Cheap checks run before a job is queued, so the user gets the error right
+    away. Returns an error message or None.
+    """
+    sens_att_list = [col for col, r in config['roles'].items() if r == 'sensitive']
+    if config['method'] == "l_diversity" and len(sens_att_list) != 1:
+        return "For l-diversity, please select exactly one sensitive attribute."
+    for col, chosen_type in config['hier_types'].items():
+        if chosen_type == "masking":
+            try:
+                check_masking(dataset.categories(col))
+            except ValueError as e:
+                return str(e)
+    return None
+
+
+def build_hierarchies(dataset, config):
+    """
+    Build the hierarchies of the quasi-identifier and sensitive columns.
+    Each hierarchy keeps integer codes per row plus one small label table per level.
+    """
+    hierarchies = {}
+    for col, role in config['roles'].items():
+        if role in ['quasi', 'sensitive']:
+            chosen_type = config['hier_types'].get(col, "none")
+            with metrics.stage('hierarchy', rows=dataset.n_rows, column=col, type=chosen_type):
+                hierarchy = build_hierarchy(
+                    col, dataset.codes(col), dataset.categories(col), chosen_type, config['custom'].get(col)
+                )
+            if hierarchy is not None:
+                hierarchies[col] = hierarchy
+    return hierarchies
+
+
+def anonymize_dataset(dataset, config, progress=None):
+    """
+    Run the configured anonymization on a Dataset.
+
+    config holds the column roles, the hierarchy type (and custom hierarchy
+    text) of each column, the method, the engine and k / l_div / supp_level.
+    progress, if given, is called with keyword arguments describing the stage
+    reached and the number of lattice nodes evaluated.
+
+    Returns an output object whose chunks() yield the anonymized rows. With the
+    built-in engines only the chosen levels and suppressions are kept, and the
+    rows are produced from the dataset codes while the output is written.
+    """
+    progress = progress or (lambda **kwargs: None)
+    roles = config['roles']
+    method = config['method']
+    quasi_ident = [col for col, r in roles.items() if r == 'quasi']
+    ident = [col for col, r in roles.items() if r == 'ident']
+    sens_att_list = [col for col, r in roles.items() if r == 'sensitive']
+
+    progress(stage="hierarchies")
+    hierarchies = build_hierarchies(dataset, config)
+    masked = [col for col in hierarchies if config['hier_types'].get(col) == "masking"]
+
+    if config['engine'] == "anjana":
+        progress(stage="loading")
+        # Imported here: anjana is slow to import and only needed by this engine
+        import anjana.anonymity as anonymity
+
+        with metrics.stage('load', rows=dataset.n_rows):
+            df = dataset.to_frame()
+            for col in masked:
+                # Masking works on the stripped string form of the column
+                df[col] = hierarchies[col].labels(0)
+
+        progress(stage="anonymizing")
+        # anjana only needs the per-level tables, not one label per row
+        anjana_hierarchies = {col: h.to_anjana() for col, h in hierarchies.items()}
+        with metrics.stage('anonymize', rows=dataset.n_rows, method=method, engine="anjana"):
+            if method == "l_diversity":
+                return FrameOutput(anonymity.l_diversity(
+                    data=df,
+                    ident=ident,
+                    quasi_ident=quasi_ident,
+                    sens_att=sens_att_list[0],
+                    k=config['k'],
+                    l_div=config['l_div'],
+                    supp_level=config['supp_level'],
+                    hierarchies=anjana_hierarchies
+                ), hierarchies)
+            return FrameOutput(anonymity.k_anonymity(
+                data=df,
+                ident=ident,
+                quasi_ident=quasi_ident,
+                k=config['k'],
+                supp_level=config['supp_level'],
+                hierarchies=anjana_hierarchies
+            ), hierarchies)
+
+    progress(stage="anonymizing")
+    # The built-in engine needs codes for every quasi-identifier, with or without hierarchy
+    engine_hierarchies = {
+        qi: hierarchies[qi] if qi in hierarchies else Hierarchy(dataset.codes(qi), [dataset.categories(qi)])
+        for qi in quasi_ident
+    }
+    sens_codes = None
+    if method == "l_diversity":
+        sens = sens_att_list[0]
+        sens_codes = hierarchies[sens].codes if sens in hierarchies else dataset.codes(sens)
+
+    def run(anonymizer):
+        with metrics.stage('anonymize', rows=dataset.n_rows, method=method, engine=config['engine']) as record:
+            transformation = anonymizer.run(
+                k=config['k'],
+                supp_level=config['supp_level'],
+                l_div=config['l_div'] if method == "l_diversity" else None,
+                search="lattice" if config['engine'] == "lattice" else "greedy",
+                workers=engine.ANONYMIZATION_WORKERS,
+                progress=lambda nodes: progress(nodes_evaluated=nodes)
+            )
+            record['nodes_evaluated'] = anonymizer.nodes_evaluated
+        return transformation
+
+    if ENGINE_CACHE_MAX_BYTES > 0:
+        # The engine depends on the data, quasi-identifiers and hierarchies, not on k / l / supp_level
+        normalized = normalize_config(config)
+        key = json.dumps([
+            dataset.content_hash,
+            quasi_ident,
+            sens_att_list[0] if method == "l_diversity" else None,
+            normalized['hierarchies'],
+        ], sort_keys=True)
+        entry = _engine_entry(key)
+        with entry[1]:
+            if entry[0] is None:
+                entry[0] = engine.Engine(engine_hierarchies, quasi_ident, sens_codes)
+            transformation = run(entry[0])
+        _trim_engines()
+    else:
+        transformation = run(engine.Engine(engine_hierarchies, quasi_ident, sens_codes))
+    return TransformedOutput(dataset, transformation, ident, dict(hierarchies, **engine_hierarchies), masked)
+
+
+def anonymize_file(input_path, output_path, config, fmt="csv", store=None, progress=None):
+    """
+    Anonymize one CSV file and write the result to output_path in the given
+    format (see output.FORMATS), chunk by chunk. store is the DatasetStore
+    parsing the input (a default one is created if not given).
+
+    Returns a summary dict of the run, including the analytics.analyze figures
+    of the result; raises ValueError for a config that does not fit the file.
+    """
+    start = time.perf_counter()
+    store = store or DatasetStore()
+    dataset = store.get(input_path)
+    missing = [col for col in config['roles'] if col not in dataset.columns]
+    if missing:
+        raise ValueError(f"Columns not found in {os.path.basename(input_path)}: {', '.join(missing)}")
+    error = validate_config(dataset, config)
+    if error:
+        raise ValueError(error)
+
+    anonymized = anonymize_dataset(dataset, config, progress=progress)
+    output.write_output(anonymized, output_path, fmt)
+    with metrics.stage('analytics', rows=anonymized.n_rows):
+        report = analytics.analyze(dataset, anonymized, config)
+    return {
+        'input': input_path,
+        'output': output_path,
+        'rows': dataset.n_rows,
+        'seconds': round(time.perf_counter() - start, 3),
+        'analytics': report,
+    }
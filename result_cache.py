@@ -0,0 +1,101 @@
+import os
+import json
+import shutil
+import threading
+
+import fileutils
+
+# Folder inside processed/ holding the memoized anonymization results
+RESULT_CACHE_FOLDER = os.path.join('processed', 'results')
+
+# Upper bound on the disk space used by memoized results
+RESULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+
+def _link(src, dst):
+    """
+    Put a copy of src at dst atomically, as a hard link when possible.
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    with fileutils.replacing(dst) as tmp_path:
+        try:
+            os.link(src, tmp_path)
+        except OSError:
+            shutil.copyfile(src, tmp_path)
+
+
+class ResultCache:
+    """
+    Anonymized CSV files stored under a key describing the input content and
+    the configuration, with a small JSON file of metadata (e.g. the preview)
+    next to each. The least recently used results are deleted once the folder
+    grows beyond max_bytes; the use of a result is recorded on its metadata
+    file, as the CSV file is shared (hard linked) with the workspaces.
+    """
+
+    def __init__(self, folder=RESULT_CACHE_FOLDER, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def _paths(self, key):
+        return os.path.join(self.folder, f"{key}.csv"), os.path.join(self.folder, f"{key}.json")
+
+    def path(self, key):
+        """
+        Path of the CSV file of the result stored under key, if there is one.
+        """
+        return self._paths(key)[0]
+
+    def get(self, key, filepath):
+        """
+        Copy the result stored under key to filepath and return its metadata,
+        or return None if there is no such result.
+        """
+        csv_path, meta_path = self._paths(key)
+        with self._lock:
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                _link(csv_path, filepath)
+            except (OSError, ValueError):
+                return None
+            # Mark the result as recently used, leaving the CSV file untouched:
+            # its modification time keys the parsed copies of the linked files
+            os.utime(meta_path)
+        return meta
+
+    def put(self, key, filepath, meta):
+        """
+        Store the result written at filepath under key, with its metadata.
+        """
+        csv_path, meta_path = self._paths(key)
+        with self._lock:
+            _link(filepath, csv_path)
+            fileutils.write_text(meta_path, json.dumps(meta))
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.folder):
+            if name.endswith('.csv'):
+                key = name[:-len('.csv')]
+                csv_path, meta_path = self._paths(key)
+                size = os.stat(csv_path).st_size
+                try:
+                    used = os.stat(meta_path).st_mtime
+                except OSError:
+                    # Metadata not written yet, or lost: the result cannot be served
+                    used = 0
+                entries.append((used, size, key))
+                total += size
+        entries.sort()
+        while len(entries) > 1 and total > self.max_bytes:
+            _, size, key = entries.pop(0)
+            for path in self._paths(key):
+                if os.path.exists(path):
+                    os.remove(path)
+            total -= size
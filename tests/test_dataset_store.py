@@ -0,0 +1,44 @@
+"""
+Parsed copies of CSV files in the columnar cache.
+"""
+import os
+
+import dataset_store
+from dataset_store import DatasetStore
+
+
+def _write(path, text, mtime_ns):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_same_name_size_and_mtime_in_other_folders(tmp_path):
+    # As after extracting an archive or copying with the modification times kept
+    a = str(tmp_path / 'a' / 'data.csv')
+    b = str(tmp_path / 'b' / 'data.csv')
+    _write(a, "age,sex\n40,Male\n", 10**18)
+    _write(b, "age,sex\n41,Fema\n", 10**18)
+    store = DatasetStore(str(tmp_path / 'cache'))
+    assert list(store.get(a).column('sex')) == ['Male']
+    assert list(DatasetStore(str(tmp_path / 'cache')).get(b).column('sex')) == ['Fema']
+    assert list(store.get(b).column('age')) == [41]
+
+
+def test_column_types_differing_between_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(dataset_store, 'CHUNK_ROWS', 4)
+    path = str(tmp_path / 'data.csv')
+    # Chunks of 4 rows: the last one reads age as text, flag as integers and code as integers
+    rows = ["40,True,a"] * 4 + ["41,False,b"] * 2 + ["42,True,c"] * 2 + ["?,1,7", "40,0,8"]
+    _write(path, "age,flag,code\n" + "\n".join(rows) + "\n", 10**18)
+    dataset = DatasetStore(str(tmp_path / 'cache')).get(path)
+    # The numbers of the first chunks and the "?" of the last one are one string column
+    assert list(dataset.categories('age')) == ['40', '41', '42', '?']
+    assert dataset.profile['age']['cardinality'] == 4
+    assert dataset.profile['age']['value_counts'] == [['40', 5], ['41', 2], ['42', 2], ['?', 1]]
+    assert list(dataset.column('age')) == ['40'] * 4 + ['41'] * 2 + ['42'] * 2 + ['?', '40']
+    # True and False are not merged with the 1 and 0 of a later integer chunk
+    assert list(dataset.categories('flag')) == ['True', 'False', '1', '0']
+    # Text first, then numbers
+    assert list(dataset.column('code')) == ['a'] * 4 + ['b'] * 2 + ['c'] * 2 + ['7', '8']
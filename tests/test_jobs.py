@@ -0,0 +1,30 @@
+"""
+Job state shared between server processes through state files.
+"""
+import os
+
+import pytest
+
+import fileutils
+from jobs import Job
+
+
+def _saved_running_job(tmp_path, pid_start):
+    job = Job('a' * 32, "test", str(tmp_path / 'job.json'))
+    job.status = "running"
+    job.pid_start = pid_start
+    job.save()
+    return Job.load(job.state_path)
+
+
+def test_job_of_a_running_process(tmp_path):
+    job = _saved_running_job(tmp_path, fileutils.process_start(os.getpid()))
+    assert job.status == "running"
+
+
+def test_job_of_a_process_whose_pid_was_reused(tmp_path):
+    # The pid is alive, but was given to this process after the one that ran the job
+    if fileutils.process_start(os.getpid()) is None:
+        pytest.skip("process start times are not available")
+    job = _saved_running_job(tmp_path, fileutils.process_start(os.getpid()) - 1)
+    assert job.status == "failed"
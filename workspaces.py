@@ -0,0 +1,114 @@
+import os
+import re
+import glob
+import time
+import shutil
+
+import fileutils
+
+# Folder holding one workspace per browser session
+WORKSPACE_FOLDER = 'workspaces'
+
+# Workspaces unused for longer than this are deleted when a new one is created,
+# at most once per WORKSPACE_CLEANUP_INTERVAL seconds in each process
+WORKSPACE_MAX_AGE = 7 * 24 * 3600
+WORKSPACE_CLEANUP_INTERVAL = 3600
+
+# Uploads are named by the SHA-256 of their content, results by their result key
+FILE_ID = re.compile(r'^[0-9a-f]{64}$')
+
+
+class Workspace:
+    """
+    Files of one session. Uploads are stored under the hash of their content
+    and anonymized results under their result key, each with a small .name file
+    holding the name shown to the user, so users uploading files with the same
+    name never share or overwrite a file.
+    """
+
+    def __init__(self, token, root=WORKSPACE_FOLDER):
+        self.token = token
+        self.folder = os.path.join(root, token)
+        self.uploads = os.path.join(self.folder, 'uploads')
+        self.results = os.path.join(self.folder, 'results')
+        # State files of the session's jobs, readable by every server process
+        self.jobs = os.path.join(self.folder, 'jobs')
+
+    def exists(self):
+        return os.path.isdir(self.folder)
+
+    def create(self):
+        os.makedirs(self.uploads, exist_ok=True)
+        os.makedirs(self.results, exist_ok=True)
+
+    def touch(self):
+        """
+        Mark the workspace as in use, so remove_stale keeps it.
+        """
+        try:
+            os.utime(self.folder)
+        except OSError:
+            pass
+
+    def _path(self, folder, file_id):
+        if not FILE_ID.match(file_id or ""):
+            return None
+        return os.path.join(folder, f"{file_id}.csv")
+
+    def upload_path(self, file_id):
+        """
+        Path of an upload of this workspace, or None for an invalid id.
+        """
+        return self._path(self.uploads, file_id)
+
+    def result_path(self, result_id):
+        return self._path(self.results, result_id)
+
+    def save_upload(self, stream, filename, store):
+        """
+        Save and parse an uploaded stream (see DatasetStore.ingest_by_content).
+        Returns the file id and the Dataset.
+        """
+        dataset, filepath = store.ingest_by_content(stream, self.uploads)
+        file_id = os.path.splitext(os.path.basename(filepath))[0]
+        self.set_name(filepath, filename)
+        return file_id, dataset
+
+    def set_name(self, filepath, name):
+        fileutils.write_text(f"{filepath}.name", name)
+
+    def name(self, filepath):
+        """
+        Name shown for a stored file (its id if it has none).
+        """
+        try:
+            with open(f"{filepath}.name", encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return os.path.basename(filepath)
+
+
+_last_cleanup = 0
+
+
+def remove_stale(root=WORKSPACE_FOLDER, max_age=WORKSPACE_MAX_AGE, store=None):
+    """
+    Delete the workspaces not used for max_age seconds, with the parsed copies
+    of their uploads in store (a DatasetStore). Does nothing if this process
+    already did so in the last WORKSPACE_CLEANUP_INTERVAL seconds.
+    """
+    global _last_cleanup
+    if time.time() - _last_cleanup < WORKSPACE_CLEANUP_INTERVAL or not os.path.isdir(root):
+        return
+    _last_cleanup = time.time()
+    limit = time.time() - max_age
+    for entry in os.scandir(root):
+        try:
+            if entry.is_dir() and entry.stat().st_mtime < limit:
+                if store is not None:
+                    # Results are linked from the result cache, so their copies may still be used
+                    for path in glob.glob(os.path.join(entry.path, 'uploads', '*.csv')):
+                        store.discard(path)
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            pass
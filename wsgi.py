@@ -0,0 +1,22 @@
+"""
+Entry point for serving the app with a multi-process WSGI server, e.g.
+
+    gunicorn --workers 4 --bind 0.0.0.0:8000 --timeout 300 wsgi:app
+    waitress-serve --listen 0.0.0.0:8000 wsgi:app
+
+Every worker process reads and writes the same folders (workspaces, columnar
+cache, result cache), so any worker can serve any request of a session.
+Run directly, the app is served with waitress when it is installed.
+"""
+import os
+
+from app import app
+
+if __name__ == '__main__':
+    try:
+        from waitress import serve
+    except ImportError:
+        print("waitress is not installed (pip install waitress); using the development server")
+        app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8000)))
+    else:
+        serve(app, host='0.0.0.0', port=int(os.environ.get('PORT', 8000)), threads=8)